@@ -125,3 +125,19 @@ STATICFILES_DIRS = [
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
+
+# Persk
+# ソート結果キャッシュの最大エントリ数（ユーザー×タイプ）
+PERSK_SORT_CACHE_SIZE = 256
+# ソートの計算場所: 'python'（アプリ側）または 'database'（ORM の annotate で計算）
+PERSK_SORT_BACKEND = 'python'
+# SortLog のバッファ書き込み（件数・最古の行の経過秒数のどちらかに達したら、
+# 追加したリクエストか、次に終了したリクエストで bulk_create。BATCH_SIZE = 1 でバッファしない）
+PERSK_SORTLOG_BATCH_SIZE = 100
+PERSK_SORTLOG_FLUSH_SECONDS = 5.0
+# SortLog の記録率（0.0〜1.0）
+PERSK_SORTLOG_SAMPLE_RATE = 1.0
+# 差分同期の削除記録を保持する日数（これより古いトークンは全件再取得）
+PERSK_TOMBSTONE_RETENTION_DAYS = 30
+# メトリクス（/api/metrics/summary/）のキャッシュ秒数（FocusLog の書き込みで破棄）
+PERSK_METRICS_CACHE_SECONDS = 30
@@ -85,20 +85,24 @@ function updateTaskTimers() {
 // 完了済みタスクの実際の時間を更新
 async function updateCompletedTaskTimes() {
     const completedTasks = state.tasks.filter(task => task.status === 'done');
+    if (completedTasks.length === 0) return;
     
-    for (const task of completedTasks) {
-        try {
-            const response = await api(`/api/tasks/${task.id}/focus-time/`);
-            if (response.ok) {
-                const actualMinutes = Math.ceil(response.total_seconds / 60);
-                const timeElement = document.getElementById(`actualTime${task.id}`);
-                if (timeElement) {
-                    timeElement.textContent = `${actualMinutes}分`;
-                }
+    try {
+        // 完了済みタスク分をまとめて1回で取得
+        const ids = completedTasks.map(task => task.id).join(',');
+        const response = await api(`/api/tasks/focus-time/?ids=${ids}`);
+        if (!response.ok) return;
+        
+        for (const task of completedTasks) {
+            const totalSeconds = response.focus_times[task.id] || 0;
+            const actualMinutes = Math.ceil(totalSeconds / 60);
+            const timeElement = document.getElementById(`actualTime${task.id}`);
+            if (timeElement) {
+                timeElement.textContent = `${actualMinutes}分`;
             }
-        } catch (error) {
-            console.error(`タスク ${task.id} の実際の時間取得エラー:`, error);
         }
+    } catch (error) {
+        console.error('完了済みタスクの実際の時間取得エラー:', error);
     }
 }
 
@@ -0,0 +1,190 @@
+"""ソート結果・メトリクスのプロセス内キャッシュ"""
+import threading
+from datetime import timedelta
+from collections import OrderedDict, defaultdict
+
+from django.conf import settings
+from django.utils import timezone
+
+
+class SortedOrderCache:
+    """ユーザー×タイプ×変更カウンタ単位のソート結果キャッシュ（LRU）
+
+    キーには UserProfile.data_version を含めるので、別プロセスや管理コマンドでの書き込みも
+    カウンタが進んだ時点で反映される（古いバージョンのエントリは LRU で追い出される）。
+    各エントリは valid_until（次にスコアが変わり得る時刻）まで有効。
+    値はリクエスト間で共有するため、モデルのインスタンスではなく変更しない素の行にする。
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # (user_id, type_name, version) -> (valid_until, value)
+        self._generations = defaultdict(int)  # user_id -> このプロセスでの無効化回数
+        self._lock = threading.Lock()
+
+    def generation(self, user_id):
+        """計算開始前に取得し、set() に渡す"""
+        with self._lock:
+            return self._generations[user_id]
+
+    def get(self, user_id, type_name, version, now=None):
+        entry = self.get_entry(user_id, type_name, version, now)
+        return None if entry is None else entry[1]
+
+    def get_entry(self, user_id, type_name, version, now=None):
+        """(valid_until, value) を返す"""
+        now = now or timezone.now()
+        key = (user_id, type_name, version)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or now >= entry[0]:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def peek(self, user_id, type_name, version, now=None):
+        """統計を更新せずに (valid_until, value) を返す"""
+        now = now or timezone.now()
+        with self._lock:
+            entry = self._entries.get((user_id, type_name, version))
+            if entry is None or now >= entry[0]:
+                return None
+            return entry
+
+    def set(self, user_id, type_name, version, value, valid_until, generation):
+        with self._lock:
+            # 計算中にこのユーザーの無効化が入った場合は古い結果を保存しない
+            if generation != self._generations[user_id]:
+                return
+            key = (user_id, type_name, version)
+            self._entries[key] = (valid_until, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate_user(self, user_id):
+        with self._lock:
+            self._generations[user_id] += 1
+            for key in [k for k in self._entries if k[0] == user_id]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            for user_id in self._generations:
+                self._generations[user_id] += 1
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+sorted_cache = SortedOrderCache(
+    max_entries=getattr(settings, 'PERSK_SORT_CACHE_SIZE', 256)
+)
+
+
+class _Flight:
+    """計算中の1件（同じキーの後続リクエストはこれを待つ）"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class MetricsCache:
+    """ユーザー×キー単位のメトリクスキャッシュ（短い TTL + 同時リクエストの集約）
+
+    同じキーの計算が進行中なら後続は完了を待って結果を共有する。
+    呼び出し側はキーに UserProfile.data_version を含め、別プロセスでの書き込みも反映されるようにする。
+    このプロセスでの FocusLog の書き込みでは invalidate_user() される。
+    """
+
+    def __init__(self, ttl_seconds=30, max_entries=1024, wait_seconds=10):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.wait_seconds = wait_seconds
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # (user_id, key) -> (expires_at, value)
+        self._inflight = {}  # (user_id, key) -> _Flight
+        self._generations = defaultdict(int)  # user_id -> このプロセスでの無効化回数
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, user_id, key, compute):
+        cache_key = (user_id, key)
+        now = timezone.now()
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is not None and now < entry[0]:
+                self._entries.move_to_end(cache_key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            flight = self._inflight.get(cache_key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[cache_key] = _Flight()
+                generation = self._generations[user_id]
+
+        if not leader:
+            # 先行リクエストの結果を待つ（待ちきれなければ自分で計算）
+            if flight.event.wait(self.wait_seconds) and flight.error is None:
+                return flight.value
+            return compute()
+
+        try:
+            flight.value = compute()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[cache_key]
+                # 計算中に無効化が入った場合は古い結果を保存しない
+                if flight.error is None and generation == self._generations[user_id]:
+                    self._entries[cache_key] = (now + timedelta(seconds=self.ttl_seconds), flight.value)
+                    self._entries.move_to_end(cache_key)
+                    while len(self._entries) > self.max_entries:
+                        self._entries.popitem(last=False)
+            flight.event.set()
+        return flight.value
+
+    def invalidate_user(self, user_id):
+        with self._lock:
+            self._generations[user_id] += 1
+            for key in [k for k in self._entries if k[0] == user_id]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            for user_id in self._generations:
+                self._generations[user_id] += 1
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'inflight': len(self._inflight),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+metrics_cache = MetricsCache(
+    ttl_seconds=getattr(settings, 'PERSK_METRICS_CACHE_SECONDS', 30)
+)
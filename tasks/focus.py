@@ -0,0 +1,190 @@
+"""フォーカス時間の記録・実行中タイマー・連続集中日数・日別集計"""
+from datetime import datetime, time, timedelta
+
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Q, Subquery, Sum
+from django.db.models.functions import Coalesce, TruncDate
+from django.utils import timezone
+
+from .models import Task, SubTask, FocusLog, ActiveTimer, FocusStreak, FocusDaily
+
+
+def record_focus(user, started_at, stopped_at, task=None, subtask=None):
+    """FocusLog を作成し、対象の total_focus_seconds を同じトランザクションで加算
+
+    渡された task / subtask の total_focus_seconds も最新値に更新するので、
+    呼び出し側がこの後 save() しても加算分を上書きしない。
+    """
+    seconds = int((stopped_at - started_at).total_seconds())
+    with transaction.atomic():
+        log = FocusLog.objects.create(
+            user=user,
+            task=task,
+            subtask=subtask,
+            started_at=started_at,
+            stopped_at=stopped_at,
+            seconds=seconds
+        )
+        for model, obj in ((Task, task), (SubTask, subtask)):
+            if obj is None:
+                continue
+            model.objects.filter(id=obj.id).update(
+                total_focus_seconds=F('total_focus_seconds') + seconds)
+            obj.refresh_from_db(fields=['total_focus_seconds'])
+    return log
+
+
+def focus_total_expression(field):
+    """FocusLog から累計フォーカス時間を求めるサブクエリ（field は 'task' か 'subtask'）"""
+    logs = (FocusLog.objects.filter(**{field: OuterRef('pk')})
+            .order_by().values(field)
+            .annotate(v=Sum('seconds')).values('v'))
+    return Coalesce(Subquery(logs), 0)
+
+
+def rebuild_focus_totals(model, ids):
+    """指定した Task / SubTask の total_focus_seconds を FocusLog から 1 回の UPDATE で再計算"""
+    field = 'task' if model is Task else 'subtask'
+    return model.objects.filter(id__in=ids).update(total_focus_seconds=focus_total_expression(field))
+
+
+def set_active_timer(user, task_id, started_at, subtask=None):
+    """実行中タイマーを登録（タスク／サブタスクごとに1件、既存は開始時刻を置き換え）
+
+    他のタスクのタイマーは残す（複数のタスクを同時に実行中にできる）。
+    """
+    ActiveTimer.objects.update_or_create(
+        user=user, task_id=task_id, subtask=subtask,
+        defaults={'started_at': started_at}
+    )
+
+
+def clear_active_timer(user, task=None, subtask=None):
+    """指定したタスク／サブタスクが実行中タイマーなら解除"""
+    timers = ActiveTimer.objects.filter(user=user)
+    if subtask is not None:
+        timers = timers.filter(subtask=subtask)
+    else:
+        # 親タスク自身のタイマーのみ（実行中のサブタスクは残す）
+        timers = timers.filter(task=task, subtask__isnull=True)
+    timers.delete()
+
+
+def focus_days(user_id):
+    """FocusLog のある日付（JST、新しい順）を1回のクエリで返す"""
+    return (FocusLog.objects
+            .filter(user_id=user_id)
+            .annotate(day=TruncDate('started_at', tzinfo=timezone.get_default_timezone()))
+            .order_by('-day')
+            .values_list('day', flat=True)
+            .distinct())
+
+
+def rebuild_streak(user_id):
+    """FocusLog から連続集中日数を再計算して保存"""
+    last_active_date = None
+    length = 0
+    for day in focus_days(user_id).iterator():
+        if last_active_date is None:
+            last_active_date = day
+        elif day != last_active_date - timedelta(days=length):
+            break
+        length += 1
+    streak, created = FocusStreak.objects.update_or_create(
+        user_id=user_id,
+        defaults={'last_active_date': last_active_date, 'current_length': length}
+    )
+    return streak
+
+
+def update_streak(user_id, started_at):
+    """FocusLog 1件の追加を連続集中日数に反映"""
+    day = timezone.localdate(started_at)
+    with transaction.atomic():
+        streak = FocusStreak.objects.select_for_update().filter(user_id=user_id).first()
+        if streak is None or (streak.last_active_date is not None and day < streak.last_active_date):
+            # 初回、または過去日のログで途中の空きが埋まった可能性がある場合は数え直す
+            rebuild_streak(user_id)
+        elif streak.last_active_date == day:
+            return
+        elif streak.last_active_date == day - timedelta(days=1):
+            streak.last_active_date = day
+            streak.current_length += 1
+            streak.save()
+        else:
+            streak.last_active_date = day
+            streak.current_length = 1
+            streak.save()
+
+
+def current_streak(user_id, today=None):
+    """今日（JST）まで続いている連続集中日数（今日のログがなければ 0）"""
+    today = today or timezone.localdate()
+    streak = FocusStreak.objects.filter(user_id=user_id).first()
+    if streak is None:
+        streak = rebuild_streak(user_id)
+    return streak.current_length if streak.last_active_date == today else 0
+
+
+def jst_day_range(day):
+    """JST の日付 day の [開始, 終了) を返す"""
+    start = timezone.make_aware(datetime.combine(day, time.min), timezone.get_default_timezone())
+    return start, start + timedelta(days=1)
+
+
+def update_focus_daily(log):
+    """FocusLog 1件の追加を日別集計に反映
+
+    タスク数は日別集計の行をロックしてから判定するので、
+    同じ日・同じタスクのログが同時に書かれても二重に数えない。
+    """
+    day = timezone.localdate(log.started_at)
+    task_id = log.task_id or SubTask.objects.filter(id=log.subtask_id).values_list('task_id', flat=True).first()
+    start, end = jst_day_range(day)
+    with transaction.atomic():
+        rollup, created = FocusDaily.objects.select_for_update().get_or_create(user_id=log.user_id, date=day)
+        new_task = 0
+        if task_id is not None:
+            # 同じ日に同じ（親）タスクのログが他になければタスク数を加算
+            seen = (FocusLog.objects
+                    .filter(user_id=log.user_id, started_at__gte=start, started_at__lt=end)
+                    .filter(Q(task_id=task_id) | Q(subtask__task_id=task_id))
+                    .exclude(id=log.id)
+                    .exists())
+            new_task = 0 if seen else 1
+        FocusDaily.objects.filter(id=rollup.id).update(
+            total_seconds=F('total_seconds') + log.seconds,
+            session_count=F('session_count') + 1,
+            task_count=F('task_count') + new_task,
+        )
+
+
+def rebuild_focus_daily(user_ids, days=None):
+    """指定ユーザー（days を渡した場合はその日付のみ）の日別集計を FocusLog から作り直す"""
+    logs = (FocusLog.objects
+            .filter(user_id__in=user_ids)
+            .annotate(day=TruncDate('started_at', tzinfo=timezone.get_default_timezone())))
+    rollups = FocusDaily.objects.filter(user_id__in=user_ids)
+    if days is not None:
+        logs = logs.filter(day__in=days)
+        rollups = rollups.filter(date__in=days)
+    rows = (logs.values('user_id', 'day')
+            .annotate(total_seconds=Sum('seconds'),
+                      session_count=Count('id'),
+                      task_count=Count(Coalesce('task_id', 'subtask__task_id'), distinct=True))
+            .order_by())
+    with transaction.atomic():
+        rollups.delete()
+        FocusDaily.objects.bulk_create([
+            FocusDaily(user_id=row['user_id'], date=row['day'], total_seconds=row['total_seconds'],
+                       session_count=row['session_count'], task_count=row['task_count'])
+            for row in rows
+        ])
+
+
+def focus_daily_totals(user_id, start_day, end_day):
+    """start_day〜end_day（JST、両端含む）の日別集計の合計"""
+    return FocusDaily.objects.filter(user_id=user_id, date__gte=start_day, date__lte=end_day).aggregate(
+        total_seconds=Coalesce(Sum('total_seconds'), 0),
+        session_count=Coalesce(Sum('session_count'), 0),
+    )
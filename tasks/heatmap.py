@@ -0,0 +1,228 @@
+"""ヒートマップの30分ビン計算
+
+FocusLog の区間（started_at〜stopped_at）を週（通常は JST 月曜 0:00 から7日間）の
+7×48 = 336 個の30分ビン（曜日×時刻）に振り分ける。
+
+split_intervals() は各区間を週開始からのマイクロ秒オフセットに変換し、
+両端の部分ビンだけを直接加算、間の満杯ビンは差分配列で数えて最後に累積和を取る。
+区間の長さによらず1件あたり定数回の整数演算で済む。
+split_intervals_loop() は30分ずつ進める従来の実装で、結果の検証・ベンチマーク用に残している。
+どちらも「ビンごとの秒数は切り捨て」という従来の規則で一致する。
+
+計算結果は FocusWeekBins（ユーザー×週の336個の配列）に保存し、FocusLog の書き込みごとに
+加算する（ビンごとの切り捨ては区間単位なので、区間ごとに足しても週全体で計算しても同じ値になる）。
+ログのない週も空の行を保存し、読み込みのたびに FocusLog を見に行かないようにする。
+"""
+import random
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import FocusLog, FocusWeekBins
+
+BIN_MINUTES = 30
+BINS_PER_DAY = 24 * 60 // BIN_MINUTES  # 48
+WEEK_BINS = 7 * BINS_PER_DAY  # 336
+
+_US = timedelta(microseconds=1)
+_SECOND_US = 1000000
+_BIN_US = BIN_MINUTES * 60 * _SECOND_US
+
+
+def bucket_index(dt_jst):
+    """30分ビンのインデックスを計算"""
+    dow = dt_jst.weekday()  # 0=Mon
+    slot = dt_jst.hour * 2 + (1 if dt_jst.minute >= 30 else 0)
+    return dow, slot  # 0..6, 0..47
+
+
+def week_range(week_start):
+    """週（week_start の 0:00 から7日間、現在のタイムゾーン）の [開始, 終了) を返す"""
+    start = timezone.make_aware(datetime.combine(week_start, datetime.min.time()))
+    return start, start + timedelta(days=7)
+
+
+def split_intervals(intervals, start):
+    """区間 (started_at, stopped_at) の列を start からの週の336ビン（秒）に振り分ける
+
+    start は現在のタイムゾーンの 0:00。タイムゾーンは固定オフセット（Asia/Tokyo）で、
+    30分境界が UTC と揃っている前提。
+    """
+    bins = [0] * WEEK_BINS
+    diff = [0] * (WEEK_BINS + 1)  # 満杯ビン（1800秒）の個数の差分
+    week_us = WEEK_BINS * _BIN_US
+    for started_at, stopped_at in intervals:
+        # 週開始からのマイクロ秒オフセット（週の範囲で切り詰め）
+        s = max((started_at - start) // _US, 0)
+        e = min((stopped_at - start) // _US, week_us)
+        if s >= e:
+            continue
+        first = s // _BIN_US
+        last = (e - 1) // _BIN_US
+        if first == last:
+            bins[first] += (e - s) // _SECOND_US
+            continue
+        # 両端の部分ビンは区間ごとに切り捨て、間は満杯
+        bins[first] += ((first + 1) * _BIN_US - s) // _SECOND_US
+        bins[last] += (e - last * _BIN_US) // _SECOND_US
+        diff[first + 1] += 1
+        diff[last] -= 1
+
+    full = 0
+    full_seconds = _BIN_US // _SECOND_US
+    for i in range(WEEK_BINS):
+        full += diff[i]
+        bins[i] += full * full_seconds
+
+    # ビンは曜日（月曜=0）で並べるので、月曜以外から始まる週はずらす
+    shift = timezone.localtime(start).weekday() * BINS_PER_DAY
+    return bins[WEEK_BINS - shift:] + bins[:WEEK_BINS - shift]
+
+
+def split_intervals_loop(intervals, start):
+    """split_intervals() の参照実装（区間を30分境界ごとに分割して加算）"""
+    bins = [[0] * BINS_PER_DAY for _ in range(7)]
+    end = start + timedelta(days=7)
+
+    for started_at, stopped_at in intervals:
+        # logを30分境界で分割加算（部分重なり分も按分）
+        log_start = max(started_at, start)
+        log_end = min(stopped_at, end)
+
+        # 30分単位で分割
+        current = log_start
+        while current < log_end:
+            next_boundary = current.replace(
+                minute=(current.minute // 30) * 30,
+                second=0,
+                microsecond=0
+            ) + timedelta(minutes=30)
+
+            segment_end = min(next_boundary, log_end)
+            segment_seconds = int((segment_end - current).total_seconds())
+
+            dow, slot = bucket_index(timezone.localtime(current))
+            bins[dow][slot] += segment_seconds
+
+            current = segment_end
+
+    return [sec for row in bins for sec in row]
+
+
+def sample_intervals(count, max_minutes, start, seed):
+    """週の前後にまたがるランダムな区間（マイクロ秒付き）を作る（ベンチマーク・テスト用）"""
+    rng = random.Random(seed)
+    intervals = []
+    for _ in range(count):
+        started_at = start + timedelta(microseconds=rng.randint(-86400 * 10 ** 6, 8 * 86400 * 10 ** 6))
+        length = timedelta(microseconds=rng.randint(1, max_minutes * 60 * 10 ** 6))
+        intervals.append((started_at, started_at + length))
+    return intervals
+
+
+def to_grid(flat_bins):
+    """336ビンを 7×48 の二次元リストにする"""
+    return [list(flat_bins[d * BINS_PER_DAY:(d + 1) * BINS_PER_DAY]) for d in range(7)]
+
+
+def monday_of(day):
+    """day を含む週の月曜日"""
+    return day - timedelta(days=day.weekday())
+
+
+def interval_weeks(started_at, stopped_at):
+    """区間が重なる週（月曜日）の一覧"""
+    if stopped_at <= started_at:
+        return [monday_of(timezone.localdate(started_at))]
+    week_start = monday_of(timezone.localdate(started_at))
+    last = monday_of(timezone.localdate(stopped_at - _US))
+    weeks = []
+    while week_start <= last:
+        weeks.append(week_start)
+        week_start += timedelta(days=7)
+    return weeks
+
+
+def logged_week_bins(user_id, week_start):
+    """FocusLog から週（week_start から7日間）の336ビンを計算"""
+    start, end = week_range(week_start)
+    intervals = (FocusLog.objects
+                 .filter(user_id=user_id, started_at__lt=end, stopped_at__gt=start)
+                 .values_list('started_at', 'stopped_at'))
+    return split_intervals(intervals, start)
+
+
+def rebuild_week_bins(user_ids, week_starts=None):
+    """指定ユーザー（week_starts を渡した場合はその週のみ）の週ビンを FocusLog から作り直す
+
+    week_starts を渡した場合は、ログのない週も空の行として保存する。
+    """
+    logs = FocusLog.objects.filter(user_id__in=user_ids)
+    rows = FocusWeekBins.objects.filter(user_id__in=user_ids)
+    if week_starts is not None:
+        overlaps = Q()
+        for week_start in week_starts:
+            start, end = week_range(week_start)
+            overlaps |= Q(started_at__lt=end, stopped_at__gt=start)
+        logs = logs.filter(overlaps)
+        rows = rows.filter(week_start__in=week_starts)
+
+    # ユーザー×週ごとに区間を集める（週をまたぐ区間は各週に入れる）
+    intervals = defaultdict(list)
+    for user_id, started_at, stopped_at in logs.values_list('user_id', 'started_at', 'stopped_at').iterator():
+        for week_start in interval_weeks(started_at, stopped_at):
+            if week_starts is None or week_start in week_starts:
+                intervals[(user_id, week_start)].append((started_at, stopped_at))
+    if week_starts is None:
+        keys = list(intervals)
+    else:
+        keys = [(user_id, week_start) for user_id in user_ids for week_start in week_starts]
+
+    with transaction.atomic():
+        rows.delete()
+        FocusWeekBins.objects.bulk_create([
+            FocusWeekBins(user_id=user_id, week_start=week_start,
+                          bins=split_intervals(intervals[(user_id, week_start)], week_range(week_start)[0]))
+            for user_id, week_start in keys
+        ])
+
+
+def get_or_create_week_bins(user_id, week_start, for_update=False):
+    """週ビンの行を取得し、なければ FocusLog から計算して作成（ログがない週も空の行を作る）
+
+    同じ週の行を他のリクエストが同時に作成して一意制約に違反した場合は読み直す。
+    for_update=True の場合は行をロックする（呼び出し側のトランザクション内で使う）。
+    """
+    rows = FocusWeekBins.objects.select_for_update() if for_update else FocusWeekBins.objects.all()
+    for attempt in range(2):
+        try:
+            # 作成は get_or_create 内のセーブポイントで行われるので、失敗してもトランザクションは続けられる
+            return rows.get_or_create(
+                user_id=user_id, week_start=week_start,
+                defaults={'bins': lambda: logged_week_bins(user_id, week_start)}
+            )
+        except IntegrityError:
+            if attempt:
+                raise
+
+
+def add_to_week_bins(log):
+    """FocusLog 1件の追加を週ビンに反映"""
+    for week_start in interval_weeks(log.started_at, log.stopped_at):
+        with transaction.atomic():
+            row, created = get_or_create_week_bins(log.user_id, week_start, for_update=True)
+            if created:
+                # 新しく作った行はこの FocusLog を含めて計算済み
+                continue
+            added = split_intervals([(log.started_at, log.stopped_at)], week_range(week_start)[0])
+            row.bins = [sec + add for sec, add in zip(row.bins, added)]
+            row.save(update_fields=['bins', 'updated_at'])
+
+
+def stored_week_bins(user, week_starts):
+    """保存済みの週ビンを1回のクエリで取得（週の月曜日 -> 336個の配列）"""
+    rows = FocusWeekBins.objects.filter(user=user, week_start__in=week_starts)
+    return dict(rows.values_list('week_start', 'bins'))
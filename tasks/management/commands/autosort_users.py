@@ -0,0 +1,85 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connections
+from tasks.models import UserProfile
+from tasks.scoring import SCORING_POLICIES
+from tasks.views import score_tasks_multi, sort_key, store_ranking
+
+
+def _init_worker():
+    """ワーカープロセスの初期化（spawn 環境でも Django を使えるようにする）"""
+    django.setup()
+    connections.close_all()
+
+
+def rank_user(user_id):
+    """1ユーザー分の全タイプのソート順を計算（ワーカーで実行）
+
+    計算前に読んだ変更カウンタも返し、保存時に計算後の書き込みの有無を判定する。
+    """
+    user = User.objects.get(id=user_id)
+    profile, created = UserProfile.objects.get_or_create(user=user)
+    rankings = {}
+    scored_by_type, valid_until = score_tasks_multi(user, list(SCORING_POLICIES), profile)
+    for type_name, scored in scored_by_type.items():
+        scored.sort(key=sort_key)
+        # プロセス間で受け渡すため、タスクは ID だけにする
+        rankings[type_name] = ([(task.id, score) for task, score, _ in scored], valid_until)
+    return user_id, profile.data_version, rankings
+
+
+class Command(BaseCommand):
+    help = '自動ソートが有効なユーザーのソート順を事前計算して保存します'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=200,
+            help='1回に処理するユーザー数'
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=1,
+            help='計算に使うプロセス数（1ならプロセスプールを使わない）'
+        )
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        workers = options['workers']
+
+        processed = 0
+        skipped = 0
+        last_id = 0
+        while True:
+            user_ids = list(UserProfile.objects.filter(auto_sort=True, user_id__gt=last_id)
+                            .order_by('user_id')
+                            .values_list('user_id', flat=True)[:chunk_size])
+            if not user_ids:
+                break
+            last_id = user_ids[-1]
+
+            if workers > 1:
+                # フォーク前に接続を閉じ、子プロセスとの共有を避ける
+                connections.close_all()
+                with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+                    results = list(pool.map(rank_user, user_ids))
+            else:
+                results = [rank_user(user_id) for user_id in user_ids]
+
+            # 書き込みは親プロセスでまとめて行う（SQLite の単一ライター対策）
+            # 計算後に書き込みがあったユーザーは古い結果なので保存しない（次回の実行で計算し直す）
+            for user_id, version, rankings in results:
+                for type_name, (ranked, valid_until) in rankings.items():
+                    if not store_ranking(user_id, type_name, ranked, valid_until, version):
+                        skipped += 1
+                        break
+            processed += len(user_ids)
+            self.stdout.write(f'{processed}人分を処理しました')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'{processed}人のソート順を保存しました（計算中に更新があり保存しなかったユーザー: {skipped}人）'))
@@ -0,0 +1,63 @@
+import time
+from datetime import timedelta, timezone as dt_timezone
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from tasks.heatmap import sample_intervals, split_intervals, split_intervals_loop, week_range
+
+
+class Command(BaseCommand):
+    help = 'ヒートマップの30分ビン計算（差分配列版と従来のループ版）の速度と結果を比較します'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--logs',
+            type=int,
+            default=5000,
+            help='区間（FocusLog 相当）の件数'
+        )
+        parser.add_argument(
+            '--max-minutes',
+            type=int,
+            default=240,
+            help='1区間の最大の長さ（分）'
+        )
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=3,
+            help='計測の繰り返し回数（最速値を表示）'
+        )
+        parser.add_argument(
+            '--seed',
+            type=int,
+            default=0,
+            help='乱数シード'
+        )
+
+    def handle(self, *args, **options):
+        today = timezone.localdate()
+        start, _ = week_range(today - timedelta(days=today.weekday()))
+        # DB から読んだ値と同じく UTC の aware datetime にする
+        intervals = [
+            (started_at.astimezone(dt_timezone.utc), stopped_at.astimezone(dt_timezone.utc))
+            for started_at, stopped_at in sample_intervals(
+                options['logs'], options['max_minutes'], start, options['seed'])
+        ]
+
+        timings = {}
+        results = {}
+        for name, func in (('loop', split_intervals_loop), ('diff', split_intervals)):
+            best = None
+            for _ in range(options['repeat']):
+                started = time.perf_counter()
+                results[name] = func(intervals, start)
+                elapsed = time.perf_counter() - started
+                best = elapsed if best is None else min(best, elapsed)
+            timings[name] = best
+            self.stdout.write(f'{name}: {best * 1000:.1f} ms')
+
+        if results['loop'] != results['diff']:
+            raise CommandError('ビンの計算結果が一致しません')
+        self.stdout.write(self.style.SUCCESS(
+            f'結果は一致しました（{options["logs"]}件、{timings["loop"] / timings["diff"]:.1f}倍高速）'))
@@ -0,0 +1,62 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db.models import Max
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+from tasks.models import SortLog
+
+
+class Command(BaseCommand):
+    help = '古い SortLog を削除、または1日1件に集約します'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days',
+            type=int,
+            default=90,
+            help='この日数より古いログを対象にする'
+        )
+        parser.add_argument(
+            '--rollup',
+            action='store_true',
+            help='削除せず、ユーザー×タイプ×モード×日ごとに最新の1件だけ残す'
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=5000,
+            help='1回の DELETE で削除する件数'
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='削除件数だけを表示'
+        )
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        chunk_size = options['chunk_size']
+
+        old_logs = SortLog.objects.filter(sorted_at__lt=cutoff)
+        if options['rollup']:
+            # 日ごとの最新（最大 id）を残す（件数によらずサブクエリのまま渡す）
+            keep_ids = (old_logs
+                        .annotate(day=TruncDate('sorted_at'))
+                        .values('user', 'type', 'mode', 'day')
+                        .annotate(keep_id=Max('id'))
+                        .values_list('keep_id', flat=True))
+            old_logs = old_logs.exclude(id__in=keep_ids)
+
+        if options['dry_run']:
+            self.stdout.write(f'{old_logs.count()}件が削除対象です（{cutoff:%Y-%m-%d %H:%M} より前）')
+            return
+
+        deleted = 0
+        while True:
+            ids = list(old_logs.order_by('id').values_list('id', flat=True)[:chunk_size])
+            if not ids:
+                break
+            deleted += SortLog.objects.filter(id__in=ids).delete()[0]
+
+        self.stdout.write(self.style.SUCCESS(f'{deleted}件の SortLog を削除しました'))
@@ -0,0 +1,23 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from tasks.models import ChangeTombstone
+
+
+class Command(BaseCommand):
+    help = '保持期間を過ぎた削除記録（差分同期用）を削除します'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days',
+            type=int,
+            default=getattr(settings, 'PERSK_TOMBSTONE_RETENTION_DAYS', 30),
+            help='この日数より古い削除記録を削除する'
+        )
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        deleted, _ = ChangeTombstone.objects.filter(deleted_at__lt=cutoff).delete()
+        self.stdout.write(self.style.SUCCESS(f'{deleted}件の削除記録を削除しました'))
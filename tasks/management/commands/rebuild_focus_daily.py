@@ -0,0 +1,41 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db.models import F
+from tasks.focus import rebuild_focus_daily, rebuild_streak
+from tasks.models import UserProfile
+
+
+class Command(BaseCommand):
+    help = 'FocusLog から日別フォーカス集計（FocusDaily）と連続集中日数を作り直します'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=200,
+            help='1回に処理するユーザー数'
+        )
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+
+        processed = 0
+        last_id = 0
+        while True:
+            # id 順にユーザー単位のチャンクで処理
+            user_ids = list(User.objects.filter(id__gt=last_id)
+                            .order_by('id')
+                            .values_list('id', flat=True)[:chunk_size])
+            if not user_ids:
+                break
+            last_id = user_ids[-1]
+
+            rebuild_focus_daily(user_ids)
+            for user_id in user_ids:
+                rebuild_streak(user_id)
+            # シグナルを通らないので、ETag 付きのメトリクスが取り直されるよう変更カウンタを進める
+            UserProfile.objects.filter(user_id__in=user_ids).update(data_version=F('data_version') + 1)
+            processed += len(user_ids)
+            self.stdout.write(f'{processed}人分を処理しました')
+
+        self.stdout.write(self.style.SUCCESS(f'{processed}人の日別フォーカス集計を作り直しました'))
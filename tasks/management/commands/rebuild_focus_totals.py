@@ -0,0 +1,56 @@
+from django.core.management.base import BaseCommand
+from tasks.focus import focus_total_expression, rebuild_focus_totals
+from tasks.models import Task, SubTask
+
+
+class Command(BaseCommand):
+    help = 'タスク・サブタスクの累計フォーカス時間を FocusLog から再計算・検証します'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=1000,
+            help='1回の UPDATE で処理する件数'
+        )
+        parser.add_argument(
+            '--verify',
+            action='store_true',
+            help='書き込まずに保存値と FocusLog の合計の不一致だけを報告'
+        )
+
+    def handle(self, *args, **options):
+        for model, field in ((Task, 'task'), (SubTask, 'subtask')):
+            self.process(model, field, options['chunk_size'], options['verify'])
+
+    def process(self, model, field, chunk_size, verify):
+        label = 'タスク' if model is Task else 'サブタスク'
+        processed = 0
+        mismatched = 0
+        last_id = 0
+        while True:
+            # id 順にチャンク単位で処理
+            ids = list(model.objects.filter(id__gt=last_id)
+                       .order_by('id')
+                       .values_list('id', flat=True)[:chunk_size])
+            if not ids:
+                break
+            last_id = ids[-1]
+            processed += len(ids)
+
+            if verify:
+                rows = (model.objects.filter(id__in=ids)
+                        .annotate(actual=focus_total_expression(field))
+                        .values_list('id', 'total_focus_seconds', 'actual'))
+                for object_id, stored, actual in rows:
+                    if stored != actual:
+                        mismatched += 1
+                        self.stdout.write(f'{label} {object_id}: 保存値 {stored} != 実際 {actual}')
+            else:
+                rebuild_focus_totals(model, ids)
+
+        if verify:
+            style = self.style.SUCCESS if mismatched == 0 else self.style.WARNING
+            self.stdout.write(style(f'{label} {processed}件を検証しました（不一致: {mismatched}件）'))
+        else:
+            self.stdout.write(self.style.SUCCESS(f'{label} {processed}件の累計フォーカス時間を更新しました'))
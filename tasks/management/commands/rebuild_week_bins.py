@@ -0,0 +1,35 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from tasks.heatmap import rebuild_week_bins
+
+
+class Command(BaseCommand):
+    help = 'FocusLog からヒートマップ用の週ビン（FocusWeekBins）を作り直します'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=100,
+            help='1回に処理するユーザー数'
+        )
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+
+        processed = 0
+        last_id = 0
+        while True:
+            # id 順にユーザー単位のチャンクで処理
+            user_ids = list(User.objects.filter(id__gt=last_id)
+                            .order_by('id')
+                            .values_list('id', flat=True)[:chunk_size])
+            if not user_ids:
+                break
+            last_id = user_ids[-1]
+
+            rebuild_week_bins(user_ids)
+            processed += len(user_ids)
+            self.stdout.write(f'{processed}人分を処理しました')
+
+        self.stdout.write(self.style.SUCCESS(f'{processed}人の週ビンを作り直しました'))
@@ -0,0 +1,66 @@
+from django.core.management.base import BaseCommand
+from django.db.models import F
+from tasks.models import Task, UserProfile, subtask_totals_expressions, refresh_subtask_totals
+
+
+class Command(BaseCommand):
+    help = 'タスクのサブタスク集計（見積合計・件数・完了数）を再計算・検証します'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=1000,
+            help='1回の UPDATE で処理するタスク数'
+        )
+        parser.add_argument(
+            '--verify',
+            action='store_true',
+            help='書き込まずに保存値と実際の集計の不一致だけを報告'
+        )
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        verify = options['verify']
+
+        fields = ['subtask_estimate_total', 'subtask_count', 'subtask_done_count']
+        actual = {f'actual_{name}': expr for name, expr in subtask_totals_expressions().items()}
+
+        processed = 0
+        mismatched = 0
+        last_id = 0
+        while True:
+            # id 順にチャンク単位で処理
+            ids = list(Task.objects.filter(id__gt=last_id)
+                       .order_by('id')
+                       .values_list('id', flat=True)[:chunk_size])
+            if not ids:
+                break
+            last_id = ids[-1]
+            processed += len(ids)
+
+            if verify:
+                rows = (Task.objects.filter(id__in=ids)
+                        .annotate(**actual)
+                        .values('id', *fields, *actual))
+                for row in rows:
+                    if any(row[name] != row[f'actual_{name}'] for name in fields):
+                        mismatched += 1
+                        self.stdout.write(
+                            f'タスク {row["id"]}: 保存値 '
+                            f'{[row[name] for name in fields]} != 実際 '
+                            f'{[row[f"actual_{name}"] for name in fields]}'
+                        )
+            else:
+                refresh_subtask_totals(ids)
+                # UPDATE はシグナルを通らないので、各プロセスのソート結果キャッシュが
+                # 古い集計を返さないよう変更カウンタを進める
+                UserProfile.objects.filter(
+                    user_id__in=Task.objects.filter(id__in=ids).values('user_id')
+                ).update(data_version=F('data_version') + 1)
+
+        if verify:
+            style = self.style.SUCCESS if mismatched == 0 else self.style.WARNING
+            self.stdout.write(style(f'{processed}件を検証しました（不一致: {mismatched}件）'))
+        else:
+            self.stdout.write(self.style.SUCCESS(f'{processed}件のサブタスク集計を更新しました'))
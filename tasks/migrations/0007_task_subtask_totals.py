@@ -0,0 +1,50 @@
+# Generated by Django 5.2.18 on 2026-10-17 20:47
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Q, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def fill_subtask_totals(apps, schema_editor):
+    """既存タスクのサブタスク集計を 1 回の UPDATE で埋める（models.subtask_totals_expressions と同じ集計）"""
+    Task = apps.get_model("tasks", "Task")
+    SubTask = apps.get_model("tasks", "SubTask")
+    subtasks = SubTask.objects.filter(task=OuterRef("pk")).order_by().values("task")
+    done = Q(done=True) | Q(status="done")
+    Task.objects.update(
+        subtask_estimate_total=Coalesce(
+            Subquery(subtasks.annotate(v=Sum("estimate_min")).values("v")), 0
+        ),
+        subtask_count=Coalesce(
+            Subquery(subtasks.annotate(v=Count("id")).values("v")), 0
+        ),
+        subtask_done_count=Coalesce(
+            Subquery(subtasks.annotate(v=Count("id", filter=done)).values("v")), 0
+        ),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("tasks", "0006_task_archive_index"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="task",
+            name="subtask_count",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="task",
+            name="subtask_done_count",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="task",
+            name="subtask_estimate_total",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(fill_subtask_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 5.2.18 on 2026-10-17 20:55
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def fill_focus_totals(apps, schema_editor):
+    """既存の FocusLog から累計フォーカス時間を埋める（focus.rebuild_focus_totals と同じ集計）"""
+    FocusLog = apps.get_model("tasks", "FocusLog")
+    for model_name, field in (("Task", "task"), ("SubTask", "subtask")):
+        logs = (
+            FocusLog.objects.filter(**{field: OuterRef("pk")})
+            .order_by()
+            .values(field)
+            .annotate(v=Sum("seconds"))
+            .values("v")
+        )
+        apps.get_model("tasks", model_name).objects.update(
+            total_focus_seconds=Coalesce(Subquery(logs), 0)
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("tasks", "0010_subtask_updated_at_changetombstone"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="subtask",
+            name="total_focus_seconds",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="task",
+            name="total_focus_seconds",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(fill_focus_totals, migrations.RunPython.noop),
+    ]
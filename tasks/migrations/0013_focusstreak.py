@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-17 21:01
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("auth", "0012_alter_user_first_name_max_length"),
+        ("tasks", "0012_activetimer"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="FocusStreak",
+            fields=[
+                (
+                    "user",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        serialize=False,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+                ("last_active_date", models.DateField(blank=True, null=True)),
+                ("current_length", models.IntegerField(default=0)),
+            ],
+        ),
+    ]
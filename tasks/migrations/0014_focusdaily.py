@@ -0,0 +1,83 @@
+# Generated by Django 5.2.18 on 2026-10-17 21:02
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Sum
+from django.db.models.functions import Coalesce, TruncDate
+from django.utils import timezone
+
+
+def fill_focus_daily(apps, schema_editor):
+    """既存の FocusLog から日別集計を作る（JST の日付単位）"""
+    FocusLog = apps.get_model("tasks", "FocusLog")
+    FocusDaily = apps.get_model("tasks", "FocusDaily")
+    rows = (
+        FocusLog.objects.annotate(
+            day=TruncDate("started_at", tzinfo=timezone.get_default_timezone())
+        )
+        .values("user_id", "day")
+        .annotate(
+            total_seconds=Sum("seconds"),
+            session_count=Count("id"),
+            task_count=Count(Coalesce("task_id", "subtask__task_id"), distinct=True),
+        )
+        .order_by()
+    )
+    FocusDaily.objects.bulk_create(
+        [
+            FocusDaily(
+                user_id=row["user_id"],
+                date=row["day"],
+                total_seconds=row["total_seconds"],
+                session_count=row["session_count"],
+                task_count=row["task_count"],
+            )
+            for row in rows.iterator()
+        ],
+        batch_size=500,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("tasks", "0013_focusstreak"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="FocusDaily",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("date", models.DateField()),
+                ("total_seconds", models.IntegerField(default=0)),
+                ("session_count", models.IntegerField(default=0)),
+                ("task_count", models.IntegerField(default=0)),
+                (
+                    "user",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+            options={
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("user", "date"), name="focus_daily_user_date_uniq"
+                    )
+                ],
+            },
+        ),
+        migrations.RunPython(fill_focus_daily, migrations.RunPython.noop),
+    ]
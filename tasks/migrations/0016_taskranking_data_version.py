@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 21:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("tasks", "0015_focusweekbins"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="taskranking",
+            name="data_version",
+            field=models.IntegerField(default=0),
+        ),
+    ]
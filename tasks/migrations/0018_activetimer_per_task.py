@@ -0,0 +1,46 @@
+# Generated by Django 5.2.18 on 2026-10-17 21:32
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("tasks", "0017_change_seq"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="activetimer",
+            name="id",
+            field=models.BigAutoField(
+                auto_created=True, primary_key=True, serialize=False, verbose_name="ID"
+            ),
+        ),
+        migrations.AlterField(
+            model_name="activetimer",
+            name="user",
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="activetimer",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(("subtask__isnull", True)),
+                fields=("user", "task"),
+                name="active_timer_user_task_uniq",
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="activetimer",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(("subtask__isnull", False)),
+                fields=("user", "subtask"),
+                name="active_timer_user_subtask_uniq",
+            ),
+        ),
+    ]
@@ -1,5 +1,6 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.db.models.functions import Coalesce
 
 
 class UserProfile(models.Model):
@@ -18,12 +19,40 @@ class UserProfile(models.Model):
     auto_sort = models.BooleanField(default=False)  # 初期=手動
     archive_after_days = models.IntegerField(default=30)  # 超過アーカイブ日数
     settings_json = models.JSONField(default=dict)
+    # タスク・サブタスク・フォーカスログ・プロフィールの変更ごとに加算（ETag 用）
+    data_version = models.IntegerField(default=0)
 
     def __str__(self):
         return f"{self.user.username} - {self.main_type}"
 
+    def save(self, *args, **kwargs):
+        # data_version は UPDATE での加算（signals.bump_data_version）でだけ進める。
+        # 読み込み後に進んだカウンタを古い値で書き戻さないよう、既存行の保存では対象から外す
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [field.name for field in self._meta.concrete_fields
+                                       if not field.primary_key and field.name != 'data_version']
+        super().save(*args, **kwargs)
 
-class Task(models.Model):
+
+class ChangeSequenced(models.Model):
+    """差分同期の順序番号（change_seq）を持つモデル
+
+    保存すると change_seq を未確定（NULL）に戻し、変更カウンタの加算時に
+    加算後の UserProfile.data_version が振られる（signals.advance_change_seq）。
+    """
+    change_seq = models.IntegerField(null=True, blank=True)
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        self.change_seq = None
+        if kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = {*kwargs['update_fields'], 'change_seq'}
+        super().save(*args, **kwargs)
+
+
+class Task(ChangeSequenced):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     title = models.CharField(max_length=200)
     deadline = models.DateTimeField()  # 必須化
@@ -43,17 +72,34 @@ class Task(models.Model):
     started_at = models.DateTimeField(null=True, blank=True)
     completed_at = models.DateTimeField(null=True, blank=True)
     shared = models.BooleanField(default=False)  # 共有フラグ
+    # サブタスク集計（SubTask の書き込み時に refresh_subtask_totals で同期）
+    subtask_estimate_total = models.IntegerField(default=0)
+    subtask_count = models.IntegerField(default=0)
+    subtask_done_count = models.IntegerField(default=0)
+    # 累計フォーカス時間（record_focus で加算、サブタスク分は含まない）
+    total_focus_seconds = models.IntegerField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return f"{self.user.username} - {self.title}"
 
+    @property
+    def effective_estimate_min(self):
+        """サブタスクがあれば子合計、なければ自身の見積"""
+        return self.subtask_estimate_total if self.subtask_count else self.estimate_min
+
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # アーカイブ判定（完了済み×完了日時）用
+            models.Index(fields=['user', 'status', 'completed_at'], name='task_user_status_done_idx'),
+            # 差分同期（順序番号の範囲・未確定の行）用
+            models.Index(fields=['user', 'change_seq'], name='task_user_change_seq_idx'),
+        ]
 
 
-class SubTask(models.Model):
+class SubTask(ChangeSequenced):
     task = models.ForeignKey(Task, on_delete=models.CASCADE, related_name="subtasks")
     title = models.CharField(max_length=200)
     estimate_min = models.IntegerField(default=15)  # 必須化、>=5、デフォルト15分
@@ -71,13 +117,38 @@ class SubTask(models.Model):
     started_at = models.DateTimeField(null=True, blank=True)
     completed_at = models.DateTimeField(null=True, blank=True)
     order_index = models.IntegerField(default=0)  # 親内の手動順（自動ソート対象外）
+    # 累計フォーカス時間（record_focus で加算）
+    total_focus_seconds = models.IntegerField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return f"{self.task.title} - {self.title}"
 
     class Meta:
         ordering = ['order_index', 'created_at']
+        indexes = [
+            models.Index(fields=['change_seq'], name='subtask_change_seq_idx'),
+        ]
+
+
+def subtask_totals_expressions():
+    """Task ごとのサブタスク集計を表すサブクエリ（見積合計・件数・完了数）"""
+    subtasks = SubTask.objects.filter(task=models.OuterRef('pk')).order_by().values('task')
+    done = models.Q(done=True) | models.Q(status='done')
+    return {
+        'subtask_estimate_total': Coalesce(
+            models.Subquery(subtasks.annotate(v=models.Sum('estimate_min')).values('v')), 0),
+        'subtask_count': Coalesce(
+            models.Subquery(subtasks.annotate(v=models.Count('id')).values('v')), 0),
+        'subtask_done_count': Coalesce(
+            models.Subquery(subtasks.annotate(v=models.Count('id', filter=done)).values('v')), 0),
+    }
+
+
+def refresh_subtask_totals(task_ids):
+    """指定タスクのサブタスク集計を 1 回の UPDATE で再計算"""
+    return Task.objects.filter(id__in=task_ids).update(**subtask_totals_expressions())
 
 
 class FocusLog(models.Model):
@@ -136,6 +207,111 @@ class SortLog(models.Model):
         ordering = ['-sorted_at']
 
 
+class ChangeTombstone(models.Model):
+    """削除されたタスク・サブタスクの記録（差分同期用、保持期間を過ぎたら削除）"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    kind = models.CharField(max_length=8)  # 'task'|'subtask'
+    object_id = models.BigIntegerField()
+    deleted_at = models.DateTimeField()
+    change_seq = models.IntegerField(null=True, blank=True)  # 差分同期の順序番号（未確定は NULL）
+
+    def __str__(self):
+        return f"{self.user.username} - {self.kind} {self.object_id} deleted at {self.deleted_at}"
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'deleted_at'], name='tombstone_user_deleted_idx'),
+            models.Index(fields=['user', 'change_seq'], name='tombstone_user_change_seq_idx'),
+        ]
+
+
+class TaskRanking(models.Model):
+    """事前計算したソート順（ユーザー×タイプ）"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    type = models.CharField(max_length=16)  # 'planner'|'sprinter'|'flow'
+    task = models.ForeignKey(Task, on_delete=models.CASCADE, related_name="rankings")
+    rank = models.IntegerField()  # 0始まり
+    score = models.FloatField()
+    valid_until = models.DateTimeField()  # この時刻以降はスコアが変わり得る
+    data_version = models.IntegerField(default=0)  # 計算前に読んだ UserProfile.data_version
+    computed_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.user.username} - {self.type} #{self.rank}"
+
+    class Meta:
+        ordering = ['rank']
+        indexes = [
+            models.Index(fields=['user', 'type', 'rank'], name='ranking_user_type_rank_idx'),
+        ]
+
+
+class ActiveTimer(models.Model):
+    """実行中タイマー（タスク／サブタスクごとに1件、開始・停止で同期）
+
+    複数のタスクを同時に実行中にできるので、ユーザーごとに複数行になることがある。
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    task = models.ForeignKey(Task, on_delete=models.CASCADE)
+    subtask = models.ForeignKey(SubTask, on_delete=models.CASCADE, null=True, blank=True)
+    started_at = models.DateTimeField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.user.username} - {self.task_id}/{self.subtask_id} since {self.started_at}"
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'task'], condition=models.Q(subtask__isnull=True),
+                                    name='active_timer_user_task_uniq'),
+            models.UniqueConstraint(fields=['user', 'subtask'], condition=models.Q(subtask__isnull=False),
+                                    name='active_timer_user_subtask_uniq'),
+        ]
+
+
+class FocusStreak(models.Model):
+    """ユーザーごとの連続集中日数（JST の日付単位、FocusLog の書き込みで更新）"""
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True)
+    last_active_date = models.DateField(null=True, blank=True)  # 最後に FocusLog がある日
+    current_length = models.IntegerField(default=0)  # last_active_date で終わる連続日数
+
+    def __str__(self):
+        return f"{self.user.username} - {self.current_length} days until {self.last_active_date}"
+
+
+class FocusDaily(models.Model):
+    """ユーザー×日（JST）ごとのフォーカス集計（FocusLog の書き込みで更新）"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    date = models.DateField()
+    total_seconds = models.IntegerField(default=0)
+    session_count = models.IntegerField(default=0)  # FocusLog の件数
+    task_count = models.IntegerField(default=0)  # 集中したタスク数（サブタスクは親タスクで数える）
+
+    def __str__(self):
+        return f"{self.user.username} - {self.date} ({self.total_seconds}s)"
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'date'], name='focus_daily_user_date_uniq'),
+        ]
+
+
+class FocusWeekBins(models.Model):
+    """ユーザー×週（JST 月曜始まり）の30分ビン（曜日×時刻の336個、秒、FocusLog の書き込みで更新）"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    week_start = models.DateField()  # 月曜日
+    bins = models.JSONField(default=list)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.user.username} - week of {self.week_start}"
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'week_start'], name='focus_week_bins_user_week_uniq'),
+        ]
+
+
 class DiagnosisAnswer(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     q_index = models.IntegerField()  # 1..7
@@ -0,0 +1,250 @@
+"""列指向のバッチスコア計算とデータベース側スコア計算
+
+common_calculation / calculate_score と同じ式を、タスクごとの dict ではなく
+特徴量ごとの配列（列）に対してまとめて適用する。
+浮動小数点の演算順序は単体版と揃えてあるため、結果は完全に一致する。
+
+同じ式を ORM の annotate で表現したものも用意しており、
+PERSK_SORT_BACKEND = 'database' の場合はデータベースで並べ替えと LIMIT を行う。
+"""
+import math
+from datetime import timedelta
+
+from django.db import NotSupportedError
+from django.db.models import (
+    Case, DateTimeField, ExpressionWrapper, F, FloatField, Func, IntegerField, Value, When,
+)
+from django.db.models.functions import Floor, Greatest, Least, Ln
+
+# 段差加点（スプリンター用）: delta_days -> 加点
+STEP_BONUS = {0: 0.6, 1: 0.4, 2: 0.15, 3: 0.05}
+
+FEATURE_NAMES = (
+    'delta_days',
+    'overdue_days',
+    'urgency',
+    'imp',
+    'penalty',
+    'overdue_bonus',
+    'short',
+    'not_started',
+    'step',
+)
+
+
+def compute_features(tasks, now):
+    """タスク群の特徴量を列ごとに一括計算"""
+    deadline = [task.deadline for task in tasks]
+    importance = [task.importance for task in tasks]
+    estimate = [task.estimate_min for task in tasks]
+    status = [task.status for task in tasks]
+    started_at = [task.started_at for task in tasks]
+
+    delta_days = [math.floor((d - now).total_seconds() / 86400) for d in deadline]
+    overdue_days = [max(0, -d) for d in delta_days]
+
+    return {
+        'delta_days': delta_days,
+        'overdue_days': overdue_days,
+        'urgency': [max(0.0, min(1.0, 1 - max(d, 0) / 14)) for d in delta_days],
+        'imp': [i / 3.0 for i in importance],
+        'penalty': [-math.log1p(e / 30.0) for e in estimate],
+        'overdue_bonus': [0.1 * o for o in overdue_days],
+        'short': [1 if e <= 15 else 0 for e in estimate],
+        'not_started': [1 if s == 'todo' and not st else 0
+                        for s, st in zip(status, started_at)],
+        'step': [STEP_BONUS.get(d, 0.0) for d in delta_days],
+    }
+
+
+# スコアリングポリシーの定義: タイプ -> ((特徴量, 重み), ...)
+# 新しい重みセットはここに追加するだけで、Python 側・データベース側の両方で使える。
+# 項は定義順に左から加算する（浮動小数点の結果を揃えるため順序に意味がある）。
+SCORING_POLICIES = {
+    'planner': (
+        ('urgency', 0.5),
+        ('imp', 0.3),
+        ('penalty', 1.0),
+        ('overdue_bonus', 1.0),
+    ),
+    'sprinter': (
+        ('urgency', 0.7),
+        ('not_started', 0.2),
+        ('imp', 0.1),
+        ('step', 1.0),
+        ('penalty', 1.0),
+        ('overdue_bonus', 1.0),
+    ),
+    'flow': (
+        ('short', 0.3),
+        ('inv_imp', 0.2),
+        ('penalty', 1.0),
+        ('overdue_bonus', 1.0),
+    ),
+}
+
+# 基本特徴量から導出する特徴量
+DERIVED_FEATURES = {
+    'inv_imp': lambda features: [1 - i for i in features['imp']],
+}
+
+
+def get_policy(type_name):
+    try:
+        return SCORING_POLICIES[type_name]
+    except KeyError:
+        raise ValueError(f"Unknown type: {type_name}")
+
+
+def _feature_column(features, name):
+    if name in DERIVED_FEATURES:
+        return DERIVED_FEATURES[name](features)
+    return features[name]
+
+
+def calculate_scores(type_name, features):
+    """タイプ別スコアを列単位で計算"""
+    terms = get_policy(type_name)
+    name, weight = terms[0]
+    scores = [weight * x for x in _feature_column(features, name)]
+    for name, weight in terms[1:]:
+        scores = [s + weight * x for s, x in zip(scores, _feature_column(features, name))]
+    return scores
+
+
+def calculate_scores_multi(type_names, features):
+    """複数タイプのスコアを同じ特徴量から計算"""
+    return {type_name: calculate_scores(type_name, features) for type_name in type_names}
+
+
+def feature_rows(features):
+    """列形式の特徴量をタスクごとの dict に戻す（calc_data 互換）"""
+    columns = [features[name] for name in FEATURE_NAMES]
+    return [dict(zip(FEATURE_NAMES, values)) for values in zip(*columns)]
+
+
+def next_change_at(tasks, features, now, archive_after_days):
+    """スコアまたはアーカイブ対象が次に変わり得る時刻を計算
+
+    delta_days は (deadline - now) が日数境界をまたぐ時点でのみ変化し、
+    アーカイブは完了済みタスクが completed_at + archive_after_days を過ぎた時点で変化する。
+    それまではソート結果が変わらないため、キャッシュの有効期限として使う。
+    """
+    candidates = [
+        task.deadline - timedelta(days=delta)
+        for task, delta in zip(tasks, features['delta_days'])
+    ]
+    candidates.extend(
+        task.completed_at + timedelta(days=archive_after_days)
+        for task in tasks if task.status == 'done' and task.completed_at
+    )
+    # いずれの候補も now 以降になる（delta_days は切り捨てのため）
+    return min(candidates, default=now + timedelta(days=1))
+
+
+# --- データベース側スコア計算 ---
+
+class EpochSeconds(Func):
+    """日時カラムを UNIX 秒（浮動小数）に変換"""
+    output_field = FloatField()
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        return self.as_sql(
+            compiler, connection,
+            template="((julianday(%(expressions)s) - 2440587.5) * 86400.0)",
+            **extra_context,
+        )
+
+    def as_postgresql(self, compiler, connection, **extra_context):
+        return self.as_sql(
+            compiler, connection,
+            template="EXTRACT(EPOCH FROM %(expressions)s)::double precision",
+            **extra_context,
+        )
+
+    def as_mysql(self, compiler, connection, **extra_context):
+        return self.as_sql(
+            compiler, connection,
+            template="UNIX_TIMESTAMP(%(expressions)s)",
+            **extra_context,
+        )
+
+    def as_sql(self, compiler, connection, **extra_context):
+        if 'template' not in extra_context:
+            raise NotSupportedError(f"EpochSeconds is not supported on {connection.vendor}")
+        return super().as_sql(compiler, connection, **extra_context)
+
+
+def _float(expression):
+    return ExpressionWrapper(expression, output_field=FloatField())
+
+
+def feature_annotations(now, estimate):
+    """common_calculation と同じ特徴量を ORM 式で表現
+
+    estimate には親の見積（子合計で同期済み）を表す式を渡す。
+    """
+    step = Case(
+        *[When(delta_days=d, then=Value(bonus)) for d, bonus in STEP_BONUS.items()],
+        default=Value(0.0),
+        output_field=FloatField(),
+    )
+    return {
+        'effective_estimate': estimate,
+        'delta_days': Floor(_float(
+            (EpochSeconds('deadline') - Value(now.timestamp())) / Value(86400.0)
+        )),
+        'overdue_days': Greatest(Value(0.0), _float(-F('delta_days'))),
+        'urgency': Greatest(
+            Value(0.0),
+            Least(Value(1.0), _float(Value(1.0) - Greatest(F('delta_days'), Value(0.0)) / Value(14.0))),
+        ),
+        'imp': _float(F('importance') / Value(3.0)),
+        'penalty': _float(-Ln(_float(Value(1.0) + F('effective_estimate') / Value(30.0)))),
+        'overdue_bonus': _float(Value(0.1) * F('overdue_days')),
+        'short': Case(When(effective_estimate__lte=15, then=Value(1)), default=Value(0),
+                      output_field=IntegerField()),
+        'not_started': Case(When(status='todo', started_at__isnull=True, then=Value(1)),
+                            default=Value(0), output_field=IntegerField()),
+        'step': step,
+        'inv_imp': _float(Value(1.0) - F('imp')),
+    }
+
+
+def score_expression(type_name):
+    """SCORING_POLICIES の式を ORM 式で表現"""
+    expression = None
+    for name, weight in get_policy(type_name):
+        term = Value(weight) * F(name)
+        expression = term if expression is None else expression + term
+    return _float(expression)
+
+
+def sort_annotations():
+    """sort_key と同じ並び順を表すキー（完了済みは末尾でまとめる）"""
+    done = When(status='done', then=Value(None))
+    return {
+        'sort_group': Case(
+            When(status='done', then=Value(2)),
+            When(overdue_days__gt=0, then=Value(0)),
+            default=Value(1),
+            output_field=IntegerField(),
+        ),
+        'sort_score': Case(done, default=F('score'), output_field=FloatField()),
+        'sort_deadline': Case(done, default=F('deadline'), output_field=DateTimeField()),
+        'sort_importance': Case(done, default=F('importance'), output_field=IntegerField()),
+        'sort_estimate': Case(done, default=F('effective_estimate'), output_field=IntegerField()),
+    }
+
+
+# created_at は秒単位で比較した後も元の並び（-created_at）が維持されるため、
+# そのまま -created_at で並べれば Python 側の安定ソートと一致する
+SORT_ORDER = (
+    'sort_group',
+    F('sort_score').desc(),
+    'sort_deadline',
+    F('sort_importance').desc(),
+    'sort_estimate',
+    '-created_at',
+    '-id',
+)
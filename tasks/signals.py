@@ -0,0 +1,171 @@
+import threading
+from contextlib import contextmanager
+
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import F, Subquery
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .cache import sorted_cache, metrics_cache
+from .focus import (
+    rebuild_focus_daily, rebuild_focus_totals, rebuild_streak, update_focus_daily, update_streak,
+)
+from .heatmap import add_to_week_bins, interval_weeks, rebuild_week_bins
+from .models import (
+    UserProfile, Task, SubTask, FocusLog, ChangeTombstone, refresh_subtask_totals,
+)
+
+
+def invalidate_sorted(user_id):
+    """ユーザーのソート結果キャッシュを破棄（コミット後にも再度破棄）
+
+    保存済みの TaskRanking は変更カウンタで新しさを判定するので削除しない。
+    """
+    sorted_cache.invalidate_user(user_id)
+    transaction.on_commit(lambda: sorted_cache.invalidate_user(user_id))
+
+
+def invalidate_metrics(user_id):
+    """ユーザーのメトリクスキャッシュを破棄（コミット後にも再度破棄）"""
+    metrics_cache.invalidate_user(user_id)
+    transaction.on_commit(lambda: metrics_cache.invalidate_user(user_id))
+
+
+def bump_data_version(user_id):
+    """ETag 用のユーザー別変更カウンタを加算"""
+    UserProfile.objects.filter(user_id=user_id).update(data_version=F('data_version') + 1)
+
+
+def advance_change_seq(user_id):
+    """変更カウンタを加算し、順序番号が未確定のタスク・サブタスク・削除記録に加算後の値を振る
+
+    差分同期はこの値をトークンにする。加算と順序番号の確定を同じトランザクションで行い、
+    カウンタの加算は行ロックで順に進むので、ある値が読めればそれ以下の順序番号の行はすべて読める。
+    """
+    with transaction.atomic():
+        bump_data_version(user_id)
+        version = Subquery(UserProfile.objects.filter(user_id=user_id).values('data_version')[:1])
+        Task.objects.filter(user_id=user_id, change_seq__isnull=True).update(change_seq=version)
+        SubTask.objects.filter(task__user_id=user_id, change_seq__isnull=True).update(change_seq=version)
+        ChangeTombstone.objects.filter(user_id=user_id, change_seq__isnull=True).update(change_seq=version)
+
+
+_deferred = threading.local()
+
+
+@contextmanager
+def deferred_user_changes():
+    """ブロック内の user_data_changed をまとめ、終了時にユーザーごと1回だけ実行"""
+    if getattr(_deferred, 'user_ids', None) is not None:
+        # 入れ子の場合は外側でまとめて実行
+        yield
+        return
+    _deferred.user_ids = set()
+    try:
+        yield
+    finally:
+        user_ids, _deferred.user_ids = _deferred.user_ids, None
+        for user_id in user_ids:
+            user_data_changed(user_id)
+
+
+def user_data_changed(user_id):
+    """タスク系データの変更を反映（ソート結果の破棄 + 変更カウンタの加算と順序番号の確定）"""
+    pending = getattr(_deferred, 'user_ids', None)
+    if pending is not None:
+        pending.add(user_id)
+        return
+    invalidate_sorted(user_id)
+    advance_change_seq(user_id)
+
+
+_pending_focus = threading.local()
+
+
+def defer_focus_rebuild(log):
+    """削除された FocusLog の対象・ユーザー・日付・週を記録し、コミット後にユーザーごと1回だけ作り直す
+
+    カスケード削除では FocusLog 1件ごとに post_delete が来るので、ここでは記録だけ行う。
+    ロールバックで取り消された分が残っても、作り直しは FocusLog からの再計算なので結果は変わらない。
+    """
+    pending = getattr(_pending_focus, 'users', None)
+    if pending is None:
+        pending = _pending_focus.users = {}
+    affected = pending.setdefault(
+        log.user_id, {'task_ids': set(), 'subtask_ids': set(), 'days': set(), 'weeks': set()})
+    if log.task_id:
+        affected['task_ids'].add(log.task_id)
+    if log.subtask_id:
+        affected['subtask_ids'].add(log.subtask_id)
+    affected['days'].add(timezone.localdate(log.started_at))
+    affected['weeks'].update(interval_weeks(log.started_at, log.stopped_at))
+    transaction.on_commit(rebuild_deferred_focus)
+
+
+def rebuild_deferred_focus():
+    """defer_focus_rebuild で記録したユーザーの集計を作り直す"""
+    pending, _pending_focus.users = getattr(_pending_focus, 'users', None), None
+    if not pending:
+        return
+    # 累計フォーカス時間（削除済みのタスク・サブタスクは 0 行更新で終わる）
+    for model, key in ((Task, 'task_ids'), (SubTask, 'subtask_ids')):
+        ids = set().union(*(affected[key] for affected in pending.values()))
+        if ids:
+            rebuild_focus_totals(model, ids)
+    # ユーザーごと削除された場合は作り直さない
+    for user_id in User.objects.filter(id__in=pending).values_list('id', flat=True):
+        affected = pending[user_id]
+        rebuild_streak(user_id)
+        rebuild_focus_daily([user_id], sorted(affected['days']))
+        rebuild_week_bins([user_id], sorted(affected['weeks']))
+        metrics_cache.invalidate_user(user_id)
+        bump_data_version(user_id)
+
+
+def record_tombstone(user_id, kind, object_id):
+    """差分同期のために削除を記録"""
+    ChangeTombstone.objects.create(user_id=user_id, kind=kind, object_id=object_id,
+                                   deleted_at=timezone.now())
+
+
+@receiver([post_save, post_delete], sender=Task)
+def task_changed(sender, instance, signal, **kwargs):
+    if signal is post_delete:
+        record_tombstone(instance.user_id, 'task', instance.id)
+    user_data_changed(instance.user_id)
+
+
+@receiver([post_save, post_delete], sender=SubTask)
+def subtask_changed(sender, instance, signal, **kwargs):
+    # 親のサブタスク集計を同期（親ごと削除中なら 0 行更新で終わる）
+    refresh_subtask_totals([instance.task_id])
+    try:
+        user_id = instance.task.user_id
+    except Task.DoesNotExist:
+        # 親タスクが先に削除済みの場合は Task 側で反映済み
+        return
+    if signal is post_delete:
+        # 親の削除に伴うカスケード削除もここで記録される
+        record_tombstone(user_id, 'subtask', instance.id)
+    user_data_changed(user_id)
+
+
+@receiver([post_save, post_delete], sender=UserProfile)
+def profile_changed(sender, instance, **kwargs):
+    user_data_changed(instance.user_id)
+
+
+@receiver([post_save, post_delete], sender=FocusLog)
+def focus_log_changed(sender, instance, signal, created=False, **kwargs):
+    if signal is post_delete:
+        # 累計フォーカス時間・集計の作り直しはコミット後にまとめて行う（加算は record_focus で行う）
+        defer_focus_rebuild(instance)
+        return
+    if created:
+        update_streak(instance.user_id, instance.started_at)
+        update_focus_daily(instance)
+        add_to_week_bins(instance)
+    invalidate_metrics(instance.user_id)
+    bump_data_version(instance.user_id)
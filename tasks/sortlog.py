@@ -0,0 +1,127 @@
+"""SortLog のバッチ書き込み
+
+読み取り API から SortLog を1件ずつ INSERT しないよう、プロセス内バッファに積んで
+件数（PERSK_SORTLOG_BATCH_SIZE）がたまるか、最も古い行が一定時間（PERSK_SORTLOG_FLUSH_SECONDS）
+を過ぎた時点で、追加したリクエストの中で bulk_create する（タイマースレッドは使わない）。
+トランザクション内で追加した場合は、コミット後（transaction.on_commit）に書き込み、
+ロールバックされたらそのバッチは破棄する。
+新しい行が来なくても、各リクエストの終了時（request_finished）に期限を過ぎたバッファを書き込み、
+プロセスの正常終了時（atexit）には残りを書き込む。
+PERSK_SORTLOG_SAMPLE_RATE で記録対象を間引ける。PERSK_SORTLOG_BATCH_SIZE を 1 にすると
+バッファせずに書き込む（テストなど）。
+
+バッファ中の行はプロセスが異常終了すると失われる（最大でバッチ1回分）。
+"""
+import atexit
+import logging
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.core.signals import request_finished
+from django.db import transaction
+from django.dispatch import receiver
+
+from .models import SortLog
+
+logger = logging.getLogger(__name__)
+
+
+class SortLogBuffer:
+    """SortLog のプロセス内バッファ
+
+    引数を省略した項目は settings（PERSK_SORTLOG_*）から都度読むので、
+    override_settings で切り替えられる。
+    """
+
+    def __init__(self, batch_size=None, flush_seconds=None, sample_rate=None):
+        self._batch_size = batch_size
+        self._flush_seconds = flush_seconds
+        self._sample_rate = sample_rate
+        self._pending = []
+        self._oldest = None  # バッファ中で最も古い行を追加した時刻（time.monotonic）
+        self._lock = threading.Lock()
+
+    @property
+    def batch_size(self):
+        if self._batch_size is not None:
+            return self._batch_size
+        return getattr(settings, 'PERSK_SORTLOG_BATCH_SIZE', 100)
+
+    @property
+    def flush_seconds(self):
+        if self._flush_seconds is not None:
+            return self._flush_seconds
+        return getattr(settings, 'PERSK_SORTLOG_FLUSH_SECONDS', 5.0)
+
+    @property
+    def sample_rate(self):
+        if self._sample_rate is not None:
+            return self._sample_rate
+        return getattr(settings, 'PERSK_SORTLOG_SAMPLE_RATE', 1.0)
+
+    def add(self, **fields):
+        """SortLog 1件をバッファに追加（サンプリング対象外なら破棄）"""
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if not self._pending:
+                self._oldest = now
+            self._pending.append(SortLog(**fields))
+            if len(self._pending) < self.batch_size and now - self._oldest < self.flush_seconds:
+                return
+            batch = self._take()
+        # トランザクション外ならすぐ、内ならコミット後に書き込む（ロールバック時は破棄）
+        transaction.on_commit(lambda: self._write(batch))
+
+    def flush(self):
+        """バッファ中の行をすぐに書き込む"""
+        with self._lock:
+            batch = self._take()
+        self._write(batch)
+
+    def flush_if_due(self, now=None):
+        """最も古い行が PERSK_SORTLOG_FLUSH_SECONDS を過ぎていれば書き込む"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if not self._pending or now - self._oldest < self.flush_seconds:
+                return
+            batch = self._take()
+        self._write(batch)
+
+    def _take(self):
+        batch, self._pending = self._pending, []
+        self._oldest = None
+        return batch
+
+    def _write(self, batch):
+        if not batch:
+            return
+        try:
+            SortLog.objects.bulk_create(batch, batch_size=max(self.batch_size, 1))
+        except Exception:
+            # ログの欠落はリクエスト処理に影響させない
+            logger.exception('SortLog の書き込みに失敗しました（%d件）', len(batch))
+
+    def clear(self):
+        """書き込まずにバッファを空にする（テスト用）"""
+        with self._lock:
+            self._take()
+
+    def pending_count(self):
+        with self._lock:
+            return len(self._pending)
+
+
+sortlog_buffer = SortLogBuffer()
+
+# 正常終了時にバッファの残りを書き込む
+atexit.register(sortlog_buffer.flush)
+
+
+@receiver(request_finished)
+def flush_due_sortlogs(sender, **kwargs):
+    """リクエストの終了時に、期限を過ぎたバッファを書き込む（次の add() を待たない）"""
+    sortlog_buffer.flush_if_due()
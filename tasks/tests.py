@@ -1,3 +1,1257 @@
-from django.test import TestCase
+import json
+import os
+import random
+import threading
+import time
+from datetime import datetime, time as time_of_day, timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.signals import request_finished
+from django.db import OperationalError, connection
+from django.db.models import F
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from . import views
+from .cache import MetricsCache, sorted_cache
+from .focus import current_streak, rebuild_streak, record_focus
+from .heatmap import (
+    logged_week_bins, sample_intervals, split_intervals, split_intervals_loop, to_grid, week_range,
+)
+from .management.commands import autosort_users
+from .models import (
+    UserProfile, Task, SubTask, FocusLog, FocusStreak, FocusDaily, FocusWeekBins, TaskRanking, SortLog,
+    ActiveTimer,
+)
+from .scoring import compute_features
+from .sortlog import SortLogBuffer, sortlog_buffer
+from .transitions import (
+    start_task, pause_task, resume_task, complete_task, update_task,
+    start_subtask, pause_subtask, resume_subtask, complete_subtask,
+)
+
+
+def create_sample_tasks(user, count=40, seed=0):
+    """ソート検証用のタスクを作成"""
+    rng = random.Random(seed)
+    now = timezone.now()
+    for i in range(count):
+        status = rng.choice(['todo', 'todo', 'doing', 'paused', 'done'])
+        task = Task.objects.create(
+            user=user,
+            title=f'task {i}',
+            deadline=now + timedelta(minutes=rng.randint(-20 * 1440, 20 * 1440)),
+            estimate_min=rng.choice([5, 10, 15, 30, 60, 120, 300]),
+            importance=rng.randint(0, 3),
+            status=status,
+            started_at=now if status == 'doing' else None,
+            completed_at=now - timedelta(days=rng.randint(0, 60)) if status == 'done' else None,
+        )
+        for j in range(rng.randint(0, 3)):
+            SubTask.objects.create(task=task, title=f'sub {i}-{j}',
+                                   estimate_min=rng.choice([5, 15, 45]), order_index=j)
+
+
+def reference_calculate_score(type_name, calc_data):
+    """列指向版に置き換える前のタイプ別スコア計算（比較用）"""
+    if type_name == 'planner':
+        return (0.5 * calc_data['urgency'] +
+                0.3 * calc_data['imp'] +
+                calc_data['penalty'] +
+                calc_data['overdue_bonus'])
+    elif type_name == 'sprinter':
+        return (0.7 * calc_data['urgency'] +
+                0.2 * calc_data['not_started'] +
+                0.1 * calc_data['imp'] +
+                calc_data['step'] +
+                calc_data['penalty'] +
+                calc_data['overdue_bonus'])
+    elif type_name == 'flow':
+        return (0.3 * calc_data['short'] +
+                0.2 * (1 - calc_data['imp']) +
+                calc_data['penalty'] +
+                calc_data['overdue_bonus'])
+    raise ValueError(f"Unknown type: {type_name}")
+
+
+def sample_intervals_for_week(start):
+    """週の境界・30分境界をまたぐ区間"""
+    return [
+        (start - timedelta(minutes=50), start + timedelta(minutes=70, microseconds=5)),
+        (start + timedelta(hours=5, minutes=29, seconds=59, microseconds=999999),
+         start + timedelta(hours=5, minutes=30, microseconds=1)),
+        (start + timedelta(days=3, seconds=10), start + timedelta(days=4, hours=2)),
+        (start + timedelta(days=6, hours=23), start + timedelta(days=7, hours=1)),
+    ]
+
+
+def tearDownModule():
+    # テスト中にバッファへ積まれた SortLog を、テスト用データベースの削除後に（atexit で）書き込まない
+    sortlog_buffer.clear()
+
+
+class SortBackendParityTest(TestCase):
+    """Python 側とデータベース側のソート結果が一致すること"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('parity', password='pw')
+        create_sample_tasks(self.user)
+        sorted_cache.clear()
+
+    def test_same_order_for_every_type(self):
+        now = views.jst_now()
+        with mock.patch.object(views, 'jst_now', return_value=now):
+            for type_name in ['planner', 'sprinter', 'flow']:
+                with self.subTest(type_name=type_name):
+                    python_side = views.compute_sorted_tasks(self.user, type_name)
+                    db_side = views.compute_sorted_tasks_db(self.user, type_name)
+                    self.assertEqual([row['id'] for row, _, _ in python_side],
+                                     [row['id'] for row, _, _ in db_side])
+                    for (_, expected, _), (_, actual, _) in zip(python_side, db_side):
+                        self.assertAlmostEqual(expected, actual, places=9)
+
+    def test_limit_returns_top_n(self):
+        now = views.jst_now()
+        with mock.patch.object(views, 'jst_now', return_value=now):
+            python_side = views.compute_sorted_tasks(self.user, 'sprinter')
+            db_side = views.compute_sorted_tasks_db(self.user, 'sprinter', limit=5)
+        self.assertEqual([row['id'] for row, _, _ in python_side[:5]],
+                         [row['id'] for row, _, _ in db_side])
+
+
+class ScoringParityTest(TestCase):
+    """列指向のスコア計算がタスクごとの common_calculation + 従来のスコア式と一致すること"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('scoring', password='pw')
+        self.now = views.jst_now()
+        shapes = {
+            'overdue': {'deadline': self.now - timedelta(days=3, hours=2), 'estimate_min': 45},
+            'due_today': {'deadline': self.now + timedelta(hours=2), 'estimate_min': 10},
+            'due_tomorrow': {'deadline': self.now + timedelta(days=1, hours=1), 'estimate_min': 15},
+            'far': {'deadline': self.now + timedelta(days=30), 'estimate_min': 300, 'importance': 3},
+            'zero_estimate': {'deadline': self.now + timedelta(days=2, hours=3), 'estimate_min': 0},
+            'started': {'deadline': self.now + timedelta(days=5), 'estimate_min': 60,
+                        'status': 'doing', 'started_at': self.now - timedelta(minutes=5)},
+            'with_subtasks': {'deadline': self.now + timedelta(days=4), 'estimate_min': 100},
+        }
+        self.tasks = {}
+        for name, fields in shapes.items():
+            self.tasks[name] = Task.objects.create(
+                user=self.user, title=name, **{'importance': 1, **fields})
+        for estimate in (20, 25):
+            SubTask.objects.create(task=self.tasks['with_subtasks'], title='sub', estimate_min=estimate)
+        sorted_cache.clear()
+
+    def reference_scores(self, type_name):
+        """置き換え前と同じ手順（親の見積は子の合計）でタスクごとに計算"""
+        scores = {}
+        for task in Task.objects.filter(user=self.user).prefetch_related('subtasks'):
+            subtasks = list(task.subtasks.all())
+            if subtasks:
+                task.estimate_min = sum(subtask.estimate_min for subtask in subtasks)
+            scores[task.id] = reference_calculate_score(type_name, views.common_calculation(task))
+        return scores
+
+    def test_same_scores_for_every_shape(self):
+        with mock.patch.object(views, 'jst_now', return_value=self.now):
+            for type_name in ['planner', 'sprinter', 'flow']:
+                with self.subTest(type_name=type_name):
+                    expected = self.reference_scores(type_name)
+                    actual = {row['id']: score
+                              for row, score, _ in views.compute_sorted_tasks(self.user, type_name)}
+                    self.assertEqual(actual, expected)
+
+    def test_features_match_common_calculation(self):
+        with mock.patch.object(views, 'jst_now', return_value=self.now):
+            for name, task in self.tasks.items():
+                with self.subTest(shape=name):
+                    features = compute_features([task], self.now)
+                    self.assertEqual({key: column[0] for key, column in features.items()},
+                                     views.common_calculation(task))
+
+    def test_missing_deadline_fails_like_common_calculation(self):
+        task = Task(user=self.user, title='no deadline', deadline=None, estimate_min=30, importance=1)
+        with mock.patch.object(views, 'jst_now', return_value=self.now):
+            with self.assertRaises(TypeError):
+                views.common_calculation(task)
+            with self.assertRaises(TypeError):
+                compute_features([task], self.now)
+
+
+class SortedOrderCacheTest(TestCase):
+    """ソート結果キャッシュが変更カウンタ単位で引かれ、素の行だけを保持すること"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('sortcache', password='pw')
+        UserProfile.objects.create(user=self.user)
+        create_sample_tasks(self.user, count=10)
+        sorted_cache.clear()
+
+    def test_write_from_another_process_is_seen(self):
+        first = views.compute_sorted_tasks(self.user, 'planner')
+        self.assertTrue(all(isinstance(row, dict) for row, _, _ in first))
+        self.assertIs(views.compute_sorted_tasks(self.user, 'planner'), first)
+
+        # 別プロセスの書き込み（このプロセスのキャッシュは無効化されず、変更カウンタだけが進む）
+        task_id = first[-1][0]['id']
+        Task.objects.filter(id=task_id).update(title='renamed')
+        UserProfile.objects.filter(user=self.user).update(data_version=F('data_version') + 1)
+        rows = {row['id']: row for row, _, _ in views.compute_sorted_tasks(self.user, 'planner')}
+        self.assertEqual(rows[task_id]['title'], 'renamed')
+
+    def test_paged_selection_is_cached(self):
+        first, total = views.select_sorted_tasks(self.user, 'planner', 3, offset=2)
+        misses = sorted_cache.stats()['misses']
+        # 2回目以降は1回につきプロフィールの読み込みだけで、全タスクを読み直さない
+        with self.assertNumQueries(2):
+            self.assertEqual(views.select_sorted_tasks(self.user, 'planner', 3, offset=2), (first, total))
+            page, _ = views.select_sorted_tasks(self.user, 'planner', 5)
+        self.assertEqual(sorted_cache.stats()['misses'], misses)
+        self.assertEqual(page[2:], first)
+        self.assertEqual(page + first[3:], views.compute_sorted_tasks(self.user, 'planner')[:5 + len(first) - 3])
+
+        # 有効期限が分かるのでページ指定でも条件付き GET が効く
+        self.client.force_login(self.user)
+        response = self.client.get('/api/tasks/sorted/', {'limit': 3, 'offset': 2})
+        self.assertEqual(self.client.get('/api/tasks/sorted/', {'limit': 3, 'offset': 2},
+                                         HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+    def test_generation_is_per_user(self):
+        generation = sorted_cache.generation(self.user.id)
+        sorted_cache.invalidate_user(self.user.id + 1)
+        sorted_cache.set(self.user.id, 'planner', 0, [], timezone.now() + timedelta(hours=1), generation)
+        self.assertEqual(sorted_cache.get(self.user.id, 'planner', 0), [])
+
+        # 計算中に同じユーザーの無効化が入った結果は保存しない
+        generation = sorted_cache.generation(self.user.id)
+        sorted_cache.invalidate_user(self.user.id)
+        sorted_cache.set(self.user.id, 'flow', 0, [], timezone.now() + timedelta(hours=1), generation)
+        self.assertIsNone(sorted_cache.get(self.user.id, 'flow', 0))
+
+
+class TaskRankingTest(TestCase):
+    """保存済みのソート順が変更カウンタで新しさを判定されること"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('ranking', password='pw')
+        UserProfile.objects.create(user=self.user)
+        create_sample_tasks(self.user, count=10)
+        sorted_cache.clear()
+
+    def store(self, version):
+        scored, valid_until = views.compute_sorted_tasks_with_expiry(self.user, 'planner')
+        ranked = [(row['id'], score) for row, score, _ in scored]
+        return views.store_ranking(self.user.id, 'planner', ranked, valid_until, version)
+
+    def test_write_after_store_is_a_miss(self):
+        self.assertTrue(self.store(views.get_data_version(self.user)))
+        count = TaskRanking.objects.filter(user=self.user).count()
+        page, total = views.load_ranking(self.user, 'planner', limit=3)
+        self.assertEqual((len(page), total), (3, count))
+
+        Task.objects.create(user=self.user, title='new', deadline=timezone.now(),
+                            estimate_min=30, importance=1)
+        self.assertIsNone(views.load_ranking(self.user, 'planner'))
+        self.assertEqual(views.get_sorted_tasks(self.user, 'planner')[1], count + 1)
+
+    def test_stale_version_is_not_stored(self):
+        version = views.get_data_version(self.user)
+        Task.objects.create(user=self.user, title='new', deadline=timezone.now(),
+                            estimate_min=30, importance=1)
+        self.assertFalse(self.store(version))
+        self.assertFalse(TaskRanking.objects.filter(user=self.user).exists())
+
+
+class AutosortUsersTest(TestCase):
+    """計算と保存の間に書き込まれたユーザーのソート順を保存しないこと"""
+
+    def test_change_between_compute_and_store(self):
+        users = []
+        for name in ('quiet', 'busy'):
+            user = User.objects.create_user(name, password='pw')
+            UserProfile.objects.create(user=user, auto_sort=True)
+            create_sample_tasks(user, count=5)
+            users.append(user)
+        quiet, busy = users
+        rank_user = autosort_users.rank_user
+
+        def rank_then_write(user_id):
+            result = rank_user(user_id)
+            if user_id == busy.id:
+                # 計算後・保存前に別のリクエストがタスクを追加
+                Task.objects.create(user=busy, title='late', deadline=timezone.now(),
+                                    estimate_min=30, importance=1)
+            return result
+
+        with mock.patch.object(autosort_users, 'rank_user', rank_then_write):
+            call_command('autosort_users', stdout=open(os.devnull, 'w'))
+
+        self.assertTrue(TaskRanking.objects.filter(user=quiet).exists())
+        self.assertFalse(TaskRanking.objects.filter(user=busy).exists())
+        # 追加されたタスクも一覧に含まれる
+        titles = [row['title'] for row, _, _ in views.get_sorted_tasks(busy, 'planner')[0]]
+        self.assertIn('late', titles)
+
+
+class ConditionalGetTest(TestCase):
+    """ETag の一致で 304 を返し、書き込み後は ETag が変わること"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('etag', password='pw')
+        UserProfile.objects.create(user=self.user)
+        self.task = Task.objects.create(user=self.user, title='task', deadline=timezone.now(),
+                                        estimate_min=30, importance=1)
+        self.client.force_login(self.user)
+
+    def get(self, url, etag=None, **params):
+        headers = {'HTTP_IF_NONE_MATCH': etag} if etag else {}
+        return self.client.get(url, params, **headers)
+
+    def post(self, url, data):
+        response = self.client.post(url, json.dumps(data), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+
+    def assert_revalidates(self, url, write, params=None):
+        """同じ ETag なら 304、write() の後は 200 で新しい ETag を返すこと"""
+        params = params or {}
+        # ソート結果は計算済みになってから ETag が付くので、2回目の応答の ETag を使う
+        self.get(url, **params)
+        etag = self.get(url, **params)['ETag']
+        self.assertEqual(self.get(url, etag, **params).status_code, 304)
+        write()
+        response = self.get(url, etag, **params)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(self.get(url, **params)['ETag'], etag)
+        return response
+
+    def test_tasks(self):
+        response = self.assert_revalidates('/api/tasks/', lambda: self.post(
+            f'/api/tasks/{self.task.id}/update/', {'title': 'renamed'}))
+        self.assertEqual(b''.join(response.streaming_content).count(b'renamed'), 1)
+
+    def test_tasks_sorted(self):
+        for params in ({}, {'limit': 1}, {'types': 'planner,flow'}):
+            with self.subTest(**params):
+                self.assert_revalidates('/api/tasks/sorted/', lambda: self.post(
+                    f'/api/tasks/{self.task.id}/update/', {'importance': self.task.importance + 1}), params)
+                self.task.refresh_from_db()
+
+    def test_profile(self):
+        response = self.assert_revalidates('/api/profile/', lambda: self.post(
+            '/api/profile/update/', {'settings': {'theme': 'dark'}}))
+        self.assertEqual(response.json()['settings'], {'theme': 'dark'})
+
+    def test_metrics_summary(self):
+        now = timezone.now()
+        response = self.assert_revalidates('/api/metrics/summary/', lambda: record_focus(
+            self.user, now, now + timedelta(minutes=10), task=self.task))
+        self.assertEqual(response.json()['ring']['actual'], 600)
+
+    def test_stale_profile_save_does_not_rewind_version(self):
+        first = self.get('/api/profile/')
+        stale = UserProfile.objects.get(user=self.user)
+        self.task.title = 'renamed'
+        self.task.save()
+        second = self.get('/api/profile/', first['ETag'])
+        self.assertEqual(second.status_code, 200)
+
+        # 読み込み後に進んだ変更カウンタを古い値で書き戻さない
+        stale.settings_json = {'theme': 'dark'}
+        stale.save()
+        third = self.get('/api/profile/', second['ETag'])
+        self.assertEqual(third.status_code, 200)
+        self.assertEqual(third.json()['settings'], {'theme': 'dark'})
+        self.assertEqual(self.get('/api/profile/', third['ETag']).status_code, 304)
+
+        # 編集した列だけを保存するので、ほかの列も巻き戻さない
+        self.client.post('/api/user/sort-settings/', json.dumps({'auto_sort': True}),
+                         content_type='application/json')
+        self.client.post('/api/profile/update/', json.dumps({'settings': {'theme': 'light'}}),
+                         content_type='application/json')
+        profile = UserProfile.objects.get(user=self.user)
+        self.assertEqual((profile.auto_sort, profile.settings_json), (True, {'theme': 'light'}))
+        self.assertNotEqual(self.get('/api/profile/', third['ETag']).status_code, 304)
+
+
+class SparseFieldsTest(TestCase):
+    """fields= / include=subtasks で返すフィールドとサブタスクを選べること"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('fields', password='pw')
+        UserProfile.objects.create(user=self.user)
+        self.task = Task.objects.create(user=self.user, title='task', deadline=timezone.now(),
+                                        estimate_min=30, importance=1)
+        self.subtask = SubTask.objects.create(task=self.task, title='sub')
+        self.client.force_login(self.user)
+
+    def tasks(self, **params):
+        response = self.client.get('/api/tasks/', params)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(b''.join(response.streaming_content))['tasks']
+
+    def sorted_rows(self, **params):
+        response = self.client.get('/api/tasks/sorted/', params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()['tasks']
+
+    def test_tasks(self):
+        [task] = self.tasks()
+        self.assertEqual(set(task), {*views.TASK_FIELDS, 'subtasks'})
+        self.assertEqual([subtask['id'] for subtask in task['subtasks']], [self.subtask.id])
+
+        # id は指定しなくても必ず返し、fields を指定するとサブタスクは include=subtasks のときだけ
+        self.assertEqual(self.tasks(fields='title,status'),
+                         [{'id': self.task.id, 'title': 'task', 'status': 'todo'}])
+        [task] = self.tasks(fields='title', include='subtasks')
+        self.assertEqual((set(task), len(task['subtasks'])), ({'id', 'title', 'subtasks'}, 1))
+        self.assertNotIn('subtasks', self.tasks(include='')[0])
+
+        self.assertEqual(self.client.get('/api/tasks/', {'fields': 'title,secret'}).status_code, 400)
+
+    def test_tasks_query_count_and_shape(self):
+        now = timezone.now()
+        query_counts = []
+        for count in (3, 30):
+            for i in range(count - Task.objects.filter(user=self.user).count()):
+                task = Task.objects.create(user=self.user, title=f'task {i}', deadline=now, estimate_min=30,
+                                           importance=1, status='doing', started_at=now)
+                SubTask.objects.create(task=task, title='sub', status='done', completed_at=now)
+            with CaptureQueriesContext(connection) as queries:
+                tasks = self.tasks()
+            query_counts.append(len(queries))
+        # タスク数によらずクエリ数は一定（チャンク内のタスクとサブタスクで1回ずつ）
+        self.assertEqual(query_counts[0], query_counts[1])
+
+        # 従来の JsonResponse と同じ形
+        expected = [{
+            'id': task.id,
+            'title': task.title,
+            'deadline': task.deadline.isoformat() if task.deadline else None,
+            'estimate_min': task.estimate_min,
+            'tags': task.tags,
+            'importance': task.importance,
+            'status': task.status,
+            'shared': task.shared,
+            'started_at': task.started_at.isoformat() if task.started_at else None,
+            'completed_at': task.completed_at.isoformat() if task.completed_at else None,
+            'subtasks': [{
+                'id': subtask.id,
+                'title': subtask.title,
+                'done': subtask.done,
+                'status': subtask.status,
+                'started_at': subtask.started_at.isoformat() if subtask.started_at else None,
+                'completed_at': subtask.completed_at.isoformat() if subtask.completed_at else None,
+            } for subtask in task.subtasks.all()],
+        } for task in Task.objects.filter(user=self.user)]
+        self.assertEqual(len(tasks), 30)
+        self.assertEqual(tasks, json.loads(json.dumps(expected)))
+
+    def test_tasks_sorted(self):
+        parent, child = self.sorted_rows()
+        self.assertEqual(set(parent), set(views.SORTED_TASK_FIELDS))
+        self.assertEqual((child['id'], child['parent_id']), (self.subtask.id, self.task.id))
+
+        # id / parent_id は指定しなくても必ず返す
+        self.assertEqual(self.sorted_rows(fields='title'),
+                         [{'id': self.task.id, 'parent_id': None, 'title': 'task'}])
+        parent, child = self.sorted_rows(fields='score', include='subtasks')
+        self.assertEqual(set(parent), {'id', 'parent_id', 'score'})
+        self.assertEqual(child['parent_id'], self.task.id)
+
+        for params in ({'fields': 'title,secret'}, {'types': 'planner,flow', 'fields': 'secret'}):
+            with self.subTest(**params):
+                self.assertEqual(self.client.get('/api/tasks/sorted/', params).status_code, 400)
+
+
+class ArchiveTest(TestCase):
+    """アーカイブの区切り（完了から archive_after_days 日）が SQL で適用され、別のページングで読めること"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('archive', password='pw')
+        UserProfile.objects.create(user=self.user, archive_after_days=30)
+        now = timezone.now()
+        self.live = self.create('live', 'todo', None)
+        self.recent = self.create('recent', 'done', now - timedelta(days=29))
+        # 完了が古い順に old 0..4（新しい順に返る）
+        self.archived = [self.create(f'old {i}', 'done', now - timedelta(days=60 - i)) for i in range(5)]
+        SubTask.objects.create(task=self.archived[-1], title='sub', status='done', completed_at=now)
+        self.client.force_login(self.user)
+
+    def create(self, title, status, completed_at):
+        return Task.objects.create(user=self.user, title=title, deadline=timezone.now(), estimate_min=30,
+                                   importance=1, status=status, completed_at=completed_at)
+
+    def archive(self, **params):
+        response = self.client.get('/api/tasks/archive/', params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_cutoff_in_sql(self):
+        sorted_ids = {row['id'] for row, _, _ in views.compute_sorted_tasks(self.user, 'planner')}
+        self.assertEqual(sorted_ids, {self.live.id, self.recent.id})
+        # 区切りは WHERE 句で適用する（アーカイブ済みの行は読み込まない）
+        with CaptureQueriesContext(connection) as queries:
+            list(views.live_tasks(self.user, timezone.now() - timedelta(days=30)))
+        self.assertIn('completed_at', queries[0]['sql'].split('WHERE', 1)[1])
+
+    def test_paging(self):
+        newest_first = [task.id for task in reversed(self.archived)]
+        first = self.archive(limit=2)
+        self.assertEqual(([task['id'] for task in first['tasks']], first['total'], first['next_offset']),
+                         (newest_first[:2], 5, 2))
+        self.assertEqual(set(first['tasks'][0]), {*views.TASK_FIELDS, 'subtasks'})
+        self.assertEqual([subtask['title'] for subtask in first['tasks'][0]['subtasks']], ['sub'])
+
+        last = self.archive(limit=2, offset=4)
+        self.assertEqual(([task['id'] for task in last['tasks']], last['next_offset']), (newest_first[4:], None))
+        self.assertEqual(self.client.get('/api/tasks/archive/', {'limit': 0}).status_code, 400)
+
+    def test_reopened_task_stays_live(self):
+        # 再開されたタスクは古い completed_at が残っていても一覧に残り、アーカイブには入らない
+        reopened = self.archived[0]
+        self.client.post(f'/api/tasks/{reopened.id}/update/', json.dumps({'status': 'todo'}),
+                         content_type='application/json')
+        sorted_ids = [row['id'] for row, _, _ in views.compute_sorted_tasks(self.user, 'planner')]
+        self.assertIn(reopened.id, sorted_ids)
+        self.assertEqual(self.archive()['total'], 4)
+
+
+class TasksChangesTest(TestCase):
+    """差分同期が順序番号のトークンで変更・削除を返すこと"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('changes', password='pw')
+        UserProfile.objects.create(user=self.user)
+        self.task = Task.objects.create(user=self.user, title='task', deadline=timezone.now(),
+                                        estimate_min=30, importance=1)
+        self.subtask = SubTask.objects.create(task=self.task, title='sub')
+        self.client.force_login(self.user)
+
+    def changes(self, token=None):
+        response = self.client.get('/api/tasks/changes/', {'since': token} if token else {})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_delta_and_tombstones(self):
+        first = self.changes()
+        self.assertTrue(first['reset'])
+        self.assertEqual([task['id'] for task in first['tasks']], [self.task.id])
+        self.assertEqual([subtask['id'] for subtask in first['subtasks']], [self.subtask.id])
+
+        # 変更がなければ空
+        second = self.changes(first['token'])
+        self.assertFalse(second['reset'])
+        self.assertEqual((second['tasks'], second['subtasks']), ([], []))
+
+        other = Task.objects.create(user=self.user, title='other', deadline=timezone.now(),
+                                    estimate_min=30, importance=1)
+        self.client.post(f'/api/tasks/{self.task.id}/start/')
+        third = self.changes(second['token'])
+        self.assertEqual(sorted(task['id'] for task in third['tasks']), sorted([self.task.id, other.id]))
+        self.assertEqual(third['subtasks'], [])
+
+        other_id = other.id
+        other.delete()
+        fourth = self.changes(third['token'])
+        self.assertEqual(fourth['tasks'], [])
+        self.assertEqual(fourth['deleted'], {'tasks': [other_id], 'subtasks': []})
+
+    def test_cascade_deleted_subtask_is_reported(self):
+        token = self.changes()['token']
+        task_id, subtask_id = self.task.id, self.subtask.id
+        self.task.delete()
+        delta = self.changes(token)
+        self.assertEqual(delta['deleted'], {'tasks': [task_id], 'subtasks': [subtask_id]})
+
+    def test_unsequenced_row_is_returned(self):
+        token = self.changes()['token']
+        # コミット済みで順序番号がまだ振られていない行（別トランザクションの書き込み途中）
+        Task.objects.filter(id=self.task.id).update(title='pending', change_seq=None)
+        delta = self.changes(token)
+        self.assertEqual([task['title'] for task in delta['tasks']], ['pending'])
+
+        # 番号が振られたら次の同期でもう一度返る
+        views.user_data_changed(self.user.id)
+        self.assertEqual([task['title'] for task in self.changes(delta['token'])['tasks']], ['pending'])
+
+
+@override_settings(PERSK_SORTLOG_BATCH_SIZE=1)
+class SortedPagingTest(TestCase):
+    """ソート済み一覧のページング（limit / offset / total / next_offset）"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('paging', password='pw')
+        UserProfile.objects.create(user=self.user)
+        create_sample_tasks(self.user, count=12)
+        sorted_cache.clear()
+        self.client.force_login(self.user)
+        self.all_ids = [row['id'] for row, _, _ in views.compute_sorted_tasks(self.user, 'planner')]
+
+    def get(self, **params):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.get('/api/tasks/sorted/', {'type': 'planner', 'fields': 'id', **params})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_pages_cover_all_tasks(self):
+        total = len(self.all_ids)
+        ids = []
+        offset = 0
+        while offset is not None:
+            page = self.get(limit=5, offset=offset)
+            self.assertEqual((page['total'], page['offset'], page['limit']), (total, offset, 5))
+            ids += [task['id'] for task in page['tasks']]
+            offset = page['next_offset']
+        self.assertEqual(ids, self.all_ids)
+
+        # 最終ページ: 残りの件数だけ返り next_offset は None
+        last = self.get(limit=5, offset=total - 2)
+        self.assertEqual(([task['id'] for task in last['tasks']], last['next_offset']),
+                         (self.all_ids[-2:], None))
+        beyond = self.get(limit=5, offset=total + 3)
+        self.assertEqual((beyond['tasks'], beyond['total'], beyond['next_offset']), ([], total, None))
+
+        # limit 省略時は全件
+        self.assertEqual([task['id'] for task in self.get()['tasks']], self.all_ids)
+        self.assertEqual(self.client.get('/api/tasks/sorted/', {'limit': 0}).status_code, 400)
+
+    def multi_and_single(self, **params):
+        multi = self.get(types='planner,flow', **params)['orderings']['planner']
+        single = self.get(**params)
+        return ([task['id'] for task in multi['tasks']], multi['total']), \
+               ([task['id'] for task in single['tasks']], single['total'])
+
+    def test_multi_types_match_single_type(self):
+        # 保存済みの並び（計算結果と異なる順）を使う場合も、計算する場合も同じ並び
+        version = UserProfile.objects.get(user=self.user).data_version
+        stored = list(reversed(self.all_ids))
+        views.store_ranking(self.user.id, 'planner', [(task_id, 0.0) for task_id in stored],
+                            timezone.now() + timedelta(hours=1), version)
+        multi, single = self.multi_and_single(limit=4, offset=2)
+        self.assertEqual(multi, single)
+        self.assertEqual(multi, (stored[2:6], len(stored)))
+
+        TaskRanking.objects.all().delete()
+        sorted_cache.clear()
+        for backend in ('python', 'database'):
+            with self.subTest(backend=backend), self.settings(PERSK_SORT_BACKEND=backend):
+                multi, single = self.multi_and_single(limit=4, offset=2)
+                self.assertEqual(multi, single)
+                self.assertEqual(multi, (self.all_ids[2:6], len(self.all_ids)))
+
+    def test_sortlog_records_global_top(self):
+        self.get(limit=3, offset=6)
+        log = SortLog.objects.get(user=self.user)
+        self.assertEqual((log.top_ids, log.item_count), (self.all_ids[:5], len(self.all_ids)))
+
+
+class SubtaskTotalsTest(TestCase):
+    """サブタスク集計が書き込みごとに同期されること"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('totals', password='pw')
+        self.task = Task.objects.create(user=self.user, title='parent', deadline=timezone.now(),
+                                        estimate_min=100, importance=1)
+
+    def assertTotals(self, estimate, count, done):
+        self.task.refresh_from_db()
+        self.assertEqual(
+            (self.task.subtask_estimate_total, self.task.subtask_count, self.task.subtask_done_count),
+            (estimate, count, done),
+        )
+
+    def test_create_update_delete(self):
+        first = SubTask.objects.create(task=self.task, title='a', estimate_min=20)
+        second = SubTask.objects.create(task=self.task, title='b', estimate_min=10)
+        self.assertTotals(30, 2, 0)
+        self.assertEqual(self.task.effective_estimate_min, 30)
+
+        first.estimate_min = 25
+        first.done = True
+        first.save()
+        self.assertTotals(35, 2, 1)
+
+        second.delete()
+        self.assertTotals(25, 1, 1)
+
+        first.delete()
+        self.assertTotals(0, 0, 0)
+        self.assertEqual(self.task.effective_estimate_min, 100)
+
+    def test_bulk_upsert(self):
+        self.client.force_login(self.user)
+        url = f'/api/subtasks/{self.task.id}/bulk_upsert/'
+        query_counts = []
+        for count in (3, 30):
+            payload = {'subtasks': [{'title': f'item {i}'} for i in range(count)]}
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.post(url, json.dumps(payload), content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+            query_counts.append(len(queries))
+        # 件数によらずクエリ数は一定
+        self.assertEqual(query_counts[0], query_counts[1])
+        self.assertTotals(33 * 15, 33, 0)
+
+        ids = list(self.task.subtasks.values_list('id', flat=True))
+        payload = {'subtasks': [{'id': subtask_id, 'done': True} for subtask_id in ids[:10]]}
+        self.client.post(url, json.dumps(payload), content_type='application/json')
+        self.assertTotals(33 * 15, 33, 10)
+
+        other = Task.objects.create(user=self.user, title='other', deadline=timezone.now(),
+                                    estimate_min=10, importance=1)
+        foreign = SubTask.objects.create(task=other, title='foreign')
+        payload = {'subtasks': [{'id': ids[0], 'title': 'renamed'}, {'id': foreign.id, 'title': 'x'}]}
+        response = self.client.post(url, json.dumps(payload), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(SubTask.objects.get(id=ids[0]).title, 'item 0')
+
+
+class FocusTotalsTest(TestCase):
+    """累計フォーカス時間が FocusLog と一致すること"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('focus', password='pw')
+        self.task = Task.objects.create(user=self.user, title='parent', deadline=timezone.now(),
+                                        estimate_min=30, importance=1)
+        self.subtask = SubTask.objects.create(task=self.task, title='child')
+
+    def test_record_and_rebuild(self):
+        now = timezone.now()
+        record_focus(self.user, now - timedelta(seconds=90), now, task=self.task)
+        record_focus(self.user, now - timedelta(seconds=30), now, subtask=self.subtask)
+        # record_focus 後の save() で加算分が消えないこと
+        self.task.save()
+        self.task.refresh_from_db()
+        self.subtask.refresh_from_db()
+        self.assertEqual((self.task.total_focus_seconds, self.subtask.total_focus_seconds), (90, 30))
+
+        self.client.force_login(self.user)
+        response = self.client.get(f'/api/tasks/focus-time/?ids={self.task.id}')
+        self.assertEqual(response.json()['focus_times'], {str(self.task.id): 120})
+
+        Task.objects.filter(id=self.task.id).update(total_focus_seconds=0)
+        FocusLog.objects.filter(subtask=self.subtask).delete()
+        call_command('rebuild_focus_totals', stdout=open(os.devnull, 'w'))
+        self.task.refresh_from_db()
+        self.subtask.refresh_from_db()
+        self.assertEqual((self.task.total_focus_seconds, self.subtask.total_focus_seconds), (90, 0))
+
+    def test_bulk_focus_time(self):
+        now = timezone.now()
+        other_user = User.objects.create_user('other', password='pw')
+        other = Task.objects.create(user=other_user, title='other', deadline=now, estimate_min=30, importance=1)
+        idle = Task.objects.create(user=self.user, title='idle', deadline=now, estimate_min=30, importance=1)
+        second = SubTask.objects.create(task=self.task, title='child 2')
+        record_focus(self.user, now - timedelta(seconds=90), now, task=self.task)
+        record_focus(self.user, now - timedelta(seconds=30), now, subtask=self.subtask)
+        record_focus(self.user, now - timedelta(seconds=20), now, subtask=second)
+        record_focus(other_user, now - timedelta(seconds=50), now, task=other)
+
+        self.client.force_login(self.user)
+        # 他ユーザーのタスクは含めず、ログのないタスクは0、サブタスク分は親に合算
+        response = self.client.get(f'/api/tasks/focus-time/?ids={self.task.id},{idle.id},{other.id}')
+        expected = {str(self.task.id): 140, str(idle.id): 0}
+        self.assertEqual(response.json()['focus_times'], expected)
+        self.assertEqual(self.client.get('/api/tasks/focus-time/').json()['focus_times'], expected)
+        self.assertEqual(self.client.get('/api/tasks/focus-time/?ids=x').status_code, 400)
+
+    def test_subtask_transitions_keep_totals_of_stale_instance(self):
+        now = timezone.now()
+        stale = SubTask.objects.get(id=self.subtask.id)
+        start_subtask(self.user, stale, now - timedelta(seconds=60))
+        record_focus(self.user, now - timedelta(seconds=30), now, subtask=self.subtask)
+        for transition in (pause_subtask, resume_subtask, complete_subtask):
+            SubTask.objects.filter(id=self.subtask.id).update(title='renamed')
+            transition(self.user, stale, now)
+        self.subtask.refresh_from_db()
+        # 累計は record_focus の30秒と pause / complete で記録した60秒ずつ
+        self.assertEqual((self.subtask.title, self.subtask.status, self.subtask.total_focus_seconds),
+                         ('renamed', 'done', 150))
+
+    def test_edit_keeps_totals_of_stale_instance(self):
+        # 読み込み後に加算された集計を、編集・共有の保存で上書きしないこと
+        stale = Task.objects.get(id=self.task.id)
+        now = timezone.now()
+        record_focus(self.user, now - timedelta(seconds=60), now, task=self.task)
+        SubTask.objects.create(task=self.task, title='added', estimate_min=15)
+
+        update_task(self.user, stale, now, {'title': 'renamed', 'status': 'done'})
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.post(f'/api/tasks/{self.task.id}/share/').status_code, 200)
+        self.task.refresh_from_db()
+        self.assertEqual((self.task.title, self.task.status, self.task.shared), ('renamed', 'done', True))
+        self.assertEqual((self.task.total_focus_seconds, self.task.subtask_count, self.task.subtask_estimate_total),
+                         (60, 2, 30))
+
+
+class CommandsApiTest(TestCase):
+    """/api/commands/ が順に実行され、失敗時は全体が取り消されること"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('commands', password='pw')
+        self.task = Task.objects.create(user=self.user, title='task', deadline=timezone.now(),
+                                        estimate_min=30, importance=1)
+        self.client.force_login(self.user)
+
+    def post(self, operations):
+        return self.client.post('/api/commands/', json.dumps({'operations': operations}),
+                                content_type='application/json')
+
+    def test_runs_in_order(self):
+        response = self.post([
+            {'op': 'task.start', 'task_id': self.task.id},
+            {'op': 'task.update', 'task_id': self.task.id, 'data': {'title': 'renamed'}},
+            {'op': 'task.complete', 'task_id': self.task.id},
+        ])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['results']), 3)
+        self.task.refresh_from_db()
+        self.assertEqual((self.task.title, self.task.status), ('renamed', 'done'))
+
+    def test_failure_rolls_back(self):
+        response = self.post([
+            {'op': 'task.update', 'task_id': self.task.id, 'data': {'title': 'renamed'}},
+            {'op': 'task.update', 'task_id': self.task.id, 'data': {'deadline': 'not a date'}},
+        ])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['index'], 1)
+        self.task.refresh_from_db()
+        self.assertEqual(self.task.title, 'task')
+
+    def test_foreign_task_is_rejected(self):
+        other = User.objects.create_user('other', password='pw')
+        task = Task.objects.create(user=other, title='other', deadline=timezone.now(),
+                                   estimate_min=30, importance=1)
+        response = self.post([{'op': 'task.delete', 'task_id': task.id}])
+        self.assertEqual(response.status_code, 404)
+        self.assertTrue(Task.objects.filter(id=task.id).exists())
+
+
+class ActiveTimerTest(TestCase):
+    """実行中タイマーがタスク／サブタスクごとに保持されること"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('timer', password='pw')
+        self.a, self.b = [
+            Task.objects.create(user=self.user, title=title, deadline=timezone.now(), estimate_min=30, importance=1)
+            for title in ('a', 'b')
+        ]
+        self.client.force_login(self.user)
+
+    def timer_keys(self):
+        return set(ActiveTimer.objects.filter(user=self.user).values_list('task_id', 'subtask_id'))
+
+    def test_pausing_one_task_keeps_others(self):
+        now = timezone.now()
+        start_task(self.user, self.a, now)
+        start_task(self.user, self.b, now + timedelta(minutes=1))
+        self.assertEqual(self.timer_keys(), {(self.a.id, None), (self.b.id, None)})
+
+        pause_task(self.user, self.b, now + timedelta(minutes=2))
+        self.assertEqual(self.timer_keys(), {(self.a.id, None)})
+        active = self.client.get('/api/timer/active/').json()
+        self.assertEqual((active['active']['task_id'], len(active['timers'])), (self.a.id, 1))
+
+    def test_subtask_timer_is_separate(self):
+        now = timezone.now()
+        subtask = SubTask.objects.create(task=self.a, title='sub', estimate_min=10)
+        start_task(self.user, self.a, now)
+        start_subtask(self.user, subtask, now + timedelta(minutes=1))
+        active = self.client.get('/api/timer/active/').json()
+        self.assertEqual([(t['task_id'], t['subtask_id']) for t in active['timers']],
+                         [(self.a.id, subtask.id), (self.a.id, None)])
+
+        pause_subtask(self.user, subtask, now + timedelta(minutes=2))
+        self.assertEqual(self.timer_keys(), {(self.a.id, None)})
+        complete_task(self.user, self.a, now + timedelta(minutes=3))
+        self.assertEqual(self.timer_keys(), set())
+        self.assertIsNone(self.client.get('/api/timer/active/').json()['active'])
+
+
+class ConcurrentTransitionTest(TransactionTestCase):
+    """同じタスクへの同時操作で FocusLog が重複しないこと"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('race', password='pw')
+        self.task = Task.objects.create(user=self.user, title='task', deadline=timezone.now(),
+                                        estimate_min=30, importance=1, status='doing',
+                                        started_at=timezone.now() - timedelta(minutes=10))
+
+    def run_concurrently(self, transition, count=8):
+        barrier = threading.Barrier(count)
+        errors = []
+
+        def worker():
+            try:
+                # 全スレッドが同じ状態を読んでから遷移させる
+                task = Task.objects.get(id=self.task.id)
+                barrier.wait()
+                for _ in range(100):
+                    try:
+                        transition(self.user, task, timezone.now())
+                        break
+                    except OperationalError:
+                        # テスト用のインメモリ SQLite はロック待ちせずに失敗するので再試行
+                        time.sleep(0.01)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def test_pause_logs_once(self):
+        self.run_concurrently(pause_task)
+        self.task.refresh_from_db()
+        self.assertEqual((self.task.status, self.task.started_at), ('paused', None))
+        self.assertEqual(FocusLog.objects.filter(task=self.task).count(), 1)
+        self.assertEqual(self.task.total_focus_seconds,
+                         FocusLog.objects.get(task=self.task).seconds)
+
+    def test_complete_logs_once(self):
+        self.run_concurrently(complete_task)
+        self.task.refresh_from_db()
+        self.assertEqual(self.task.status, 'done')
+        self.assertEqual(FocusLog.objects.filter(task=self.task).count(), 1)
+
+    def test_resume_starts_once(self):
+        # 一時停止中（started_at なし）の再開を同時に押しても、2回目がほぼ0秒のログを作らないこと
+        Task.objects.filter(id=self.task.id).update(status='paused', started_at=None)
+        self.run_concurrently(resume_task)
+        self.task.refresh_from_db()
+        self.assertEqual(self.task.status, 'doing')
+        self.assertFalse(FocusLog.objects.filter(task=self.task).exists())
+        timer = ActiveTimer.objects.get(user=self.user)
+        self.assertEqual((timer.task_id, timer.started_at), (self.task.id, self.task.started_at))
+
+
+class FocusStreakTest(TestCase):
+    """連続集中日数が JST の日付で数えられ、書き込みごとに更新されること"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('streak', password='pw')
+
+    def log(self, started_at):
+        return FocusLog.objects.create(user=self.user, started_at=started_at,
+                                       stopped_at=started_at + timedelta(minutes=10), seconds=600)
+
+    def test_jst_day_boundaries(self):
+        jst = timezone.get_default_timezone()
+        today = timezone.localdate()
+        at = lambda day, hour, minute=0: timezone.make_aware(
+            datetime.combine(today - timedelta(days=day), time_of_day(hour, minute)), jst)
+
+        # 前日 23:30 と当日 0:30（JST）は UTC では同じ日付
+        self.log(at(1, 23, 30))
+        self.log(at(0, 0, 30))
+        self.assertEqual(current_streak(self.user.id), 2)
+
+        # 空いていた日を後から埋めると数え直す
+        self.log(at(3, 12))
+        self.assertEqual(current_streak(self.user.id), 2)
+        gap = self.log(at(2, 12))
+        self.assertEqual(current_streak(self.user.id), 4)
+        self.assertEqual(FocusStreak.objects.get(user=self.user).current_length,
+                         rebuild_streak(self.user.id).current_length)
+
+        # 削除分はコミット後に作り直す
+        with self.captureOnCommitCallbacks(execute=True):
+            gap.delete()
+        self.assertEqual(current_streak(self.user.id), 2)
+
+
+class FocusDailyTest(TestCase):
+    """日別集計が FocusLog の書き込みごとに更新され、作り直した結果と一致すること"""
+
+    def test_incremental_matches_rebuild(self):
+        user = User.objects.create_user('daily', password='pw')
+        UserProfile.objects.create(user=user)
+        task = Task.objects.create(user=user, title='task', deadline=timezone.now(),
+                                   estimate_min=30, importance=1)
+        subtask = SubTask.objects.create(task=task, title='sub')
+        other = Task.objects.create(user=user, title='other', deadline=timezone.now(),
+                                    estimate_min=30, importance=1)
+        now = timezone.now()
+        for started_at, kwargs in [
+            (now, {'task': task}),
+            (now, {'subtask': subtask}),
+            (now, {'task': other}),
+            (now - timedelta(days=1), {'task': task}),
+        ]:
+            record_focus(user, started_at - timedelta(minutes=5), started_at, **kwargs)
+
+        def snapshot():
+            return list(FocusDaily.objects.filter(user=user).order_by('date')
+                        .values_list('date', 'total_seconds', 'session_count', 'task_count'))
+
+        incremental = snapshot()
+        today = timezone.localdate(now - timedelta(minutes=5))
+        self.assertEqual(incremental[-1], (today, 900, 3, 2))
+        version = UserProfile.objects.get(user=user).data_version
+        call_command('rebuild_focus_daily', stdout=open(os.devnull, 'w'))
+        self.assertEqual(snapshot(), incremental)
+        # ETag 付きのメトリクスが取り直されるよう変更カウンタが進む
+        self.assertGreater(UserProfile.objects.get(user=user).data_version, version)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            FocusLog.objects.filter(task=other).delete()
+        self.assertEqual(snapshot()[-1], (today, 600, 2, 1))
+
+
+class FocusLogDeleteTest(TestCase):
+    """FocusLog の削除（カスケード含む）で集計の作り直しがユーザーごと1回にまとまること"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('cascade', password='pw')
+        self.keep = Task.objects.create(user=self.user, title='keep', deadline=timezone.now(),
+                                        estimate_min=30, importance=1)
+        record_focus(self.user, timezone.now() - timedelta(minutes=30), timezone.now(), task=self.keep)
+
+    def create_task_with_logs(self, count):
+        task = Task.objects.create(user=self.user, title='task', deadline=timezone.now(),
+                                   estimate_min=30, importance=1)
+        subtask = SubTask.objects.create(task=task, title='sub')
+        now = timezone.now()
+        for i in range(count):
+            started_at = now - timedelta(days=i % 10, minutes=20)
+            record_focus(self.user, started_at, started_at + timedelta(minutes=10),
+                         **({'task': task} if i % 2 else {'subtask': subtask}))
+        return task
+
+    def test_cascade_delete_query_count(self):
+        for count in (10, 100):
+            with self.subTest(count=count):
+                task = self.create_task_with_logs(count)
+                # ログの件数によらずクエリ数は一定
+                with self.assertNumQueries(45), self.captureOnCommitCallbacks(execute=True):
+                    task.delete()
+
+        self.assertEqual(list(FocusDaily.objects.filter(user=self.user)
+                              .values_list('session_count', 'task_count')), [(1, 1)])
+        self.assertEqual(current_streak(self.user.id), 1)
+        for week_start, bins in FocusWeekBins.objects.filter(user=self.user).values_list('week_start', 'bins'):
+            self.assertEqual(bins, logged_week_bins(self.user.id, week_start))
+        self.keep.refresh_from_db()
+        self.assertEqual(self.keep.total_focus_seconds, 1800)
+
+
+class SortLogBufferTest(TestCase):
+    """SortLog が件数・経過時間で書き込まれ、トランザクション内ではコミット後に書かれること"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('sortlog', password='pw')
+        self.buffer = SortLogBuffer(batch_size=3, flush_seconds=60, sample_rate=1.0)
+
+    def add(self, buffer=None):
+        # TestCase 全体がトランザクション内なので、コミット後の書き込みをその場で実行する
+        with self.captureOnCommitCallbacks(execute=True):
+            self.add_in_transaction(buffer)
+
+    def add_in_transaction(self, buffer=None):
+        (buffer or self.buffer).add(user=self.user, type='planner', mode='manual',
+                                    sorted_at=timezone.now(), item_count=1, top_ids=[])
+
+    def test_flush_when_full(self):
+        self.add()
+        self.add()
+        self.assertEqual(SortLog.objects.count(), 0)
+        self.add()
+        self.assertEqual(SortLog.objects.count(), 3)
+        self.assertEqual(self.buffer.pending_count(), 0)
+
+    def test_flush_when_oldest_is_due(self):
+        with mock.patch('tasks.sortlog.time.monotonic', return_value=100.0):
+            self.add()
+        with mock.patch('tasks.sortlog.time.monotonic', return_value=160.0):
+            self.add()
+        self.assertEqual(SortLog.objects.count(), 2)
+
+    def test_flush_after_commit(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            for _ in range(3):
+                self.add_in_transaction()
+        self.assertEqual(SortLog.objects.count(), 0)
+        for callback in callbacks:
+            callback()
+        self.assertEqual(SortLog.objects.count(), 3)
+
+    def test_flush_on_request_finished(self):
+        with mock.patch('tasks.sortlog.sortlog_buffer', self.buffer):
+            with mock.patch('tasks.sortlog.time.monotonic', return_value=100.0):
+                self.add()
+            # 新しい行が来なくても、期限を過ぎていればリクエストの終了時に書き込む
+            with mock.patch('tasks.sortlog.time.monotonic', return_value=130.0):
+                request_finished.send(sender=self.__class__)
+            self.assertEqual(SortLog.objects.count(), 0)
+            with mock.patch('tasks.sortlog.time.monotonic', return_value=160.0):
+                request_finished.send(sender=self.__class__)
+        self.assertEqual((SortLog.objects.count(), self.buffer.pending_count()), (1, 0))
+
+    @override_settings(PERSK_SORTLOG_BATCH_SIZE=1)
+    def test_unbuffered_by_setting(self):
+        self.add(SortLogBuffer())
+        self.assertEqual(SortLog.objects.count(), 1)
+
+    def test_prune_rollup_keeps_latest_per_day(self):
+        old = timezone.now() - timedelta(days=100)
+        for hours in range(5):
+            SortLog.objects.create(user=self.user, type='planner', mode='manual',
+                                   sorted_at=old + timedelta(minutes=hours), item_count=hours, top_ids=[])
+        call_command('prune_sortlogs', '--rollup', stdout=open(os.devnull, 'w'))
+        self.assertEqual(list(SortLog.objects.values_list('item_count', flat=True)), [4])
+
+
+class MetricsCacheTest(TestCase):
+    """同じキーの同時計算が1回にまとめられ、無効化後は再計算されること"""
+
+    def test_concurrent_requests_compute_once(self):
+        cache = MetricsCache(ttl_seconds=60)
+        calls = []
+        started = threading.Event()
+        release = threading.Event()
+
+        def compute():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return {'value': len(calls)}
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get_or_compute(1, 'day', compute)))
+                   for _ in range(5)]
+        threads[0].start()
+        started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        time.sleep(0.05)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{'value': 1}] * 5)
+        self.assertEqual(cache.get_or_compute(1, 'day', compute), {'value': 1})
+
+        cache.invalidate_user(1)
+        self.assertEqual(cache.get_or_compute(1, 'day', compute), {'value': 2})
+
+    def test_invalidation_is_per_user(self):
+        cache = MetricsCache(ttl_seconds=60)
+
+        def compute():
+            # 計算中に別ユーザーの無効化が入っても、このユーザーの結果は保存する
+            cache.invalidate_user(2)
+            return {'value': 1}
+
+        cache.get_or_compute(1, 'day', compute)
+        self.assertEqual(cache.get_or_compute(1, 'day', lambda: {'value': 2}), {'value': 1})
+
+    def test_summary_follows_writes_from_other_processes(self):
+        user = User.objects.create_user('metrics', password='pw')
+        UserProfile.objects.create(user=user)
+        self.client.force_login(user)
+        first = self.client.get('/api/metrics/summary/')
+        self.assertEqual(first.json()['ring']['actual'], 0)
+
+        # 別プロセスでの書き込み（このプロセスのキャッシュは無効化されない）
+        now = timezone.now()
+        with mock.patch('tasks.signals.invalidate_metrics'):
+            FocusLog.objects.create(user=user, started_at=now, stopped_at=now + timedelta(minutes=10), seconds=600)
+        second = self.client.get('/api/metrics/summary/', HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(second.status_code, 200)
+        self.assertNotEqual(second['ETag'], first['ETag'])
+        self.assertEqual(second.json()['ring']['actual'], 600)
+        self.assertEqual(self.client.get('/api/metrics/summary/', HTTP_IF_NONE_MATCH=second['ETag']).status_code, 304)
+
+
+class HeatmapBinsTest(TestCase):
+    """差分配列版のビン計算が従来のループ版と一致すること"""
+
+    def test_matches_loop(self):
+        start, _ = week_range(timezone.localdate())
+        for seed in range(5):
+            intervals = sample_intervals(300, 600, start, seed)
+            self.assertEqual(split_intervals(intervals, start), split_intervals_loop(intervals, start))
+
+    def test_week_bins_from_logs(self):
+        user = User.objects.create_user('heatmap', password='pw')
+        today = timezone.localdate()
+        week_start = today - timedelta(days=today.weekday())
+        start, _ = week_range(week_start)
+        for started_at, stopped_at in sample_intervals_for_week(start):
+            FocusLog.objects.create(user=user, started_at=started_at, stopped_at=stopped_at,
+                                    seconds=int((stopped_at - started_at).total_seconds()))
+        logs = FocusLog.objects.filter(user=user).values_list('started_at', 'stopped_at')
+        self.assertEqual(views.week_bins(user, week_start), to_grid(split_intervals_loop(logs, start)))
+
+    def test_stored_bins_follow_writes(self):
+        user = User.objects.create_user('weekbins', password='pw')
+        today = timezone.localdate()
+        week_start = today - timedelta(days=today.weekday())
+        start, _ = week_range(week_start)
+        logs = [FocusLog.objects.create(user=user, started_at=started_at, stopped_at=stopped_at,
+                                        seconds=int((stopped_at - started_at).total_seconds()))
+                for started_at, stopped_at in sample_intervals_for_week(start)]
+
+        def stored():
+            return dict(FocusWeekBins.objects.filter(user=user).values_list('week_start', 'bins'))
+
+        def expected(week):
+            week_start_dt, _ = week_range(week)
+            intervals = FocusLog.objects.filter(user=user).values_list('started_at', 'stopped_at')
+            return split_intervals_loop(intervals, week_start_dt)
+
+        # 書き込みごとの加算結果がループ版・作り直しと一致
+        incremental = stored()
+        self.assertEqual(sorted(incremental),
+                         [week_start - timedelta(days=7), week_start, week_start + timedelta(days=7)])
+        for week, bins in incremental.items():
+            self.assertEqual(bins, expected(week))
+        call_command('rebuild_week_bins', stdout=open(os.devnull, 'w'))
+        self.assertEqual(stored(), incremental)
+
+        # 削除時はコミット後にその週を作り直す
+        with self.captureOnCommitCallbacks(execute=True):
+            logs[2].delete()
+        self.assertEqual(stored()[week_start], expected(week_start))
+        self.assertEqual(views.week_bins(user, week_start), to_grid(expected(week_start)))
+
+    def test_empty_week_is_stored(self):
+        user = User.objects.create_user('emptyweek', password='pw')
+        today = timezone.localdate()
+        week_start = today - timedelta(days=today.weekday() + 14)
+        self.assertEqual(views.week_bins(user, week_start), to_grid([0] * 336))
+        # 2回目以降は保存済みの空の行を読むだけ（FocusLog を見に行かない）
+        with self.assertNumQueries(1):
+            self.assertEqual(views.week_bins(user, week_start), to_grid([0] * 336))
+
+        # 空の行にも書き込みが加算される
+        start, _ = week_range(week_start)
+        FocusLog.objects.create(user=user, started_at=start, stopped_at=start + timedelta(minutes=10),
+                                seconds=600)
+        self.assertEqual(views.week_bins(user, week_start)[0][0], 600)
+
+    def test_reads_do_not_store_future_weeks(self):
+        user = User.objects.create_user('futureweek', password='pw')
+        self.client.force_login(user)
+        today = timezone.localdate()
+        future = today - timedelta(days=today.weekday()) + timedelta(days=28)
+        response = self.client.get('/api/analytics/heatmap/', {'week_start': future.isoformat()})
+        self.assertEqual(response.json()['max_sec'], 0)
+        self.assertFalse(FocusWeekBins.objects.filter(user=user).exists())
+
+        # 遡る週数には上限がある
+        for params in ({'window': 0}, {'window': 53}, {'mode': 'month', 'window': 14}):
+            with self.subTest(**params):
+                self.assertEqual(self.client.get('/api/analytics/heatmap_avg/', params).status_code, 400)
+        self.assertEqual(self.client.get('/api/analytics/heatmap_avg/', {'window': 2}).status_code, 200)
+        self.assertEqual(FocusWeekBins.objects.filter(user=user).count(), 2)
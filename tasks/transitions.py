@@ -0,0 +1,212 @@
+"""タスク・サブタスクの状態遷移
+
+単体の API ビューと /api/commands/ の一括実行で共通に使う。
+各関数は取得済み（権限確認済み）のオブジェクトを受け取り、レスポンスに含める値を返す。
+タスクのタイマー操作は status / started_at を条件にした UPDATE で行い、
+ダブルクリックや複数端末からの同時操作でも FocusLog が重複しない。
+サブタスクの遷移は変更した列だけを保存し、読み込み後に加算された累計フォーカス時間を上書きしない。
+"""
+from datetime import datetime
+
+from django.db import transaction
+
+from .focus import record_focus, set_active_timer, clear_active_timer
+from .models import Task
+from .signals import user_data_changed
+
+
+# 競合時に読み直して遷移をやり直す回数
+TRANSITION_RETRIES = 3
+
+
+def _transition(user, task, now, changes_for):
+    """status / started_at が読み取り時から変わっていない場合だけ、必要な列を UPDATE する
+
+    changes_for(task) は (更新する列, FocusLog を作るか) を返す（既に遷移先なら列は None）。
+    他のリクエストが先に更新していた場合は読み直し、既に同じ遷移先の状態になっていれば
+    何もしない（ダブルクリックで再開が2回記録されないように）。そうでなければやり直す。
+    実際に更新できたときだけ FocusLog を作成する。(記録した秒数, 更新したか) を返す。
+    """
+    for _ in range(TRANSITION_RETRIES):
+        changes, log_focus = changes_for(task)
+        if changes is None:
+            return 0, False
+        with transaction.atomic():
+            updated = (Task.objects
+                       .filter(id=task.id, status=task.status, started_at=task.started_at)
+                       .update(updated_at=now, change_seq=None, **changes))
+            if updated:
+                seconds = 0
+                if log_focus:
+                    # FocusLogを作成（累計フォーカス時間も加算）
+                    seconds = record_focus(user, task.started_at, now, task=task).seconds
+                for name, value in changes.items():
+                    setattr(task, name, value)
+                task.updated_at = now
+                # UPDATE はシグナルを通らないので明示的に反映
+                user_data_changed(task.user_id)
+                return seconds, True
+        task.refresh_from_db(fields=['status', 'started_at', 'completed_at'])
+        if task.status == changes['status']:
+            return 0, False
+    raise ValueError('Task was updated concurrently, please retry')
+
+
+def start_task(user, task, now):
+    """タスク開始（実行中なら何もしない）"""
+    def changes_for(task):
+        if task.status == 'doing':
+            return None, False
+        return {'status': 'doing', 'started_at': now}, False
+
+    with transaction.atomic():
+        seconds, changed = _transition(user, task, now, changes_for)
+        if changed:
+            set_active_timer(user, task.id, task.started_at)
+    return {'started_at': task.started_at.isoformat() if task.started_at else now.isoformat()}
+
+
+def pause_task(user, task, now):
+    """タスク一時停止"""
+    def changes_for(task):
+        if task.status == 'paused' and task.started_at is None:
+            return None, False
+        return {'status': 'paused', 'started_at': None}, task.started_at is not None
+
+    with transaction.atomic():
+        seconds, changed = _transition(user, task, now, changes_for)
+        if changed:
+            clear_active_timer(user, task=task)
+    return {'logged_seconds': seconds}
+
+
+def resume_task(user, task, now):
+    """タスク再開"""
+    def changes_for(task):
+        return {'status': 'doing', 'started_at': now}, task.started_at is not None
+
+    with transaction.atomic():
+        elapsed_seconds, changed = _transition(user, task, now, changes_for)
+        if changed:
+            set_active_timer(user, task.id, task.started_at)
+    # 他のリクエストが先に再開していた場合はその開始時刻を返す
+    return {'started_at': (task.started_at or now).isoformat(), 'logged_seconds': elapsed_seconds}
+
+
+def complete_task(user, task, now):
+    """タスク完了（完了済みなら何もしない）"""
+    def changes_for(task):
+        if task.status == 'done':
+            return None, False
+        # 実行中ならログを作成
+        log_focus = task.status == 'doing' and task.started_at is not None
+        return {'status': 'done', 'completed_at': now, 'started_at': None}, log_focus
+
+    with transaction.atomic():
+        seconds, changed = _transition(user, task, now, changes_for)
+        if changed:
+            clear_active_timer(user, task=task)
+    return {'completed_at': (task.completed_at or now).isoformat()}
+
+
+# update_task で編集できる列
+TASK_EDITABLE_FIELDS = ('title', 'deadline', 'estimate_min', 'tags', 'importance', 'status')
+
+
+def update_task(user, task, now, data):
+    """タスク更新
+
+    編集した列だけを保存する（読み込み後に加算された累計フォーカス時間やサブタスク集計を上書きしない）。
+    """
+    if 'title' in data:
+        task.title = data['title']
+    if 'deadline' in data:
+        task.deadline = datetime.fromisoformat(data['deadline']) if data['deadline'] else None
+    if 'estimate_min' in data:
+        task.estimate_min = data['estimate_min']
+    if 'tags' in data:
+        task.tags = data['tags']
+    if 'importance' in data:
+        task.importance = data['importance']
+    if 'status' in data:
+        task.status = data['status']
+
+    with transaction.atomic():
+        task.save(update_fields=[name for name in TASK_EDITABLE_FIELDS if name in data] + ['updated_at'])
+        if 'status' in data and task.status != 'doing':
+            clear_active_timer(user, task=task)
+    return {}
+
+
+def delete_task(user, task, now):
+    """タスク削除"""
+    task.delete()
+    return {}
+
+
+def start_subtask(user, subtask, now):
+    """サブタスク開始"""
+    subtask.status = 'doing'
+    subtask.started_at = now
+    with transaction.atomic():
+        subtask.save(update_fields=['status', 'started_at', 'updated_at'])
+        set_active_timer(user, subtask.task_id, now, subtask=subtask)
+    return {'started_at': now.isoformat()}
+
+
+def pause_subtask(user, subtask, now):
+    """サブタスク一時停止"""
+    seconds = 0  # 初期化
+    with transaction.atomic():
+        if subtask.started_at:
+            # FocusLogを作成（累計フォーカス時間も加算）
+            seconds = record_focus(user, subtask.started_at, now, subtask=subtask).seconds
+
+        subtask.status = 'paused'
+        # started_atをNoneに設定しない（経過時間を維持するため）
+        subtask.save(update_fields=['status', 'updated_at'])
+        clear_active_timer(user, subtask=subtask)
+    return {'logged_seconds': seconds}
+
+
+def resume_subtask(user, subtask, now):
+    """サブタスク再開"""
+    subtask.status = 'doing'
+    # started_atは既存の値を維持（経過時間を保持するため）
+    with transaction.atomic():
+        subtask.save(update_fields=['status', 'updated_at'])
+        set_active_timer(user, subtask.task_id, subtask.started_at or now, subtask=subtask)
+    return {'started_at': subtask.started_at.isoformat() if subtask.started_at else now.isoformat()}
+
+
+def complete_subtask(user, subtask, now):
+    """サブタスク完了"""
+    with transaction.atomic():
+        # 実行中ならログを作成
+        if subtask.status == 'doing' and subtask.started_at:
+            record_focus(user, subtask.started_at, now, subtask=subtask)
+
+        subtask.status = 'done'
+        subtask.completed_at = now
+        subtask.started_at = None
+        subtask.save(update_fields=['status', 'completed_at', 'started_at', 'updated_at'])
+        clear_active_timer(user, subtask=subtask)
+    return {'completed_at': now.isoformat()}
+
+
+# /api/commands/ の op 名 -> 遷移関数
+TASK_OPERATIONS = {
+    'task.start': start_task,
+    'task.pause': pause_task,
+    'task.resume': resume_task,
+    'task.complete': complete_task,
+    'task.update': update_task,
+    'task.delete': delete_task,
+}
+
+SUBTASK_OPERATIONS = {
+    'subtask.start': start_subtask,
+    'subtask.pause': pause_subtask,
+    'subtask.resume': resume_subtask,
+    'subtask.complete': complete_subtask,
+}
@@ -14,6 +14,8 @@ urlpatterns = [
     
     # API
     path('api/tasks/', views.api_tasks, name='api_tasks'),
+    path('api/tasks/archive/', views.api_tasks_archive, name='api_tasks_archive'),
+    path('api/tasks/changes/', views.api_tasks_changes, name='api_tasks_changes'),
     path('api/tasks/create/', views.api_task_create, name='api_task_create'),
     path('api/tasks/<int:task_id>/update/', views.api_task_update, name='api_task_update'),
     path('api/tasks/<int:task_id>/delete/', views.api_task_delete, name='api_task_delete'),
@@ -29,12 +31,15 @@ urlpatterns = [
     path('api/subtasks/<int:subtask_id>/complete/', views.api_subtask_complete, name='api_subtask_complete'),
     
     path('api/subtasks/<int:task_id>/bulk_upsert/', views.api_subtasks_bulk_upsert, name='api_subtasks_bulk_upsert'),
+    path('api/commands/', views.api_commands, name='api_commands'),
+    path('api/timer/active/', views.api_active_timer, name='api_active_timer'),
     
     path('api/diagnosis/submit/', views.api_diagnosis_submit, name='api_diagnosis_submit'),
     path('api/profile/', views.api_profile, name='api_profile'),
     path('api/profile/update/', views.api_profile_update, name='api_profile_update'),
     path('api/metrics/summary/', views.api_metrics_summary, name='api_metrics_summary'),
     path('api/tasks/<int:task_id>/focus-time/', views.api_task_focus_time, name='api_task_focus_time'),
+    path('api/tasks/focus-time/', views.api_tasks_focus_time, name='api_tasks_focus_time'),
     
     # 新しいソート関連API
     path('api/tasks/sorted/', views.api_tasks_sorted, name='api_tasks_sorted'),
@@ -1,17 +1,44 @@
+import base64
+import hashlib
+import heapq
 import json
 import math
+from collections import defaultdict
 from datetime import datetime, timedelta
+from operator import itemgetter
 from django.shortcuts import render, get_object_or_404, redirect
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth import logout
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib import messages
-from django.http import JsonResponse
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import JsonResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
-from django.views.decorators.http import require_http_methods
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import require_http_methods, condition
 from django.utils import timezone
-from django.db.models import Prefetch
-from .models import UserProfile, Task, SubTask, FocusLog, DiagnosisAnswer, SortLog, TimelineEvent, TimelineLike
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Prefetch, Case, When, F, Q, Sum
+from django.db.models.functions import Coalesce
+from .models import (
+    UserProfile, Task, SubTask, DiagnosisAnswer, TimelineEvent, TimelineLike, TaskRanking,
+    ChangeTombstone, ActiveTimer, refresh_subtask_totals,
+)
+from .scoring import (
+    FEATURE_NAMES, SCORING_POLICIES, SORT_ORDER, compute_features, calculate_scores,
+    calculate_scores_multi, feature_rows, next_change_at, feature_annotations, score_expression,
+    sort_annotations,
+)
+from .cache import sorted_cache, metrics_cache
+from .focus import current_streak, focus_daily_totals
+from .heatmap import get_or_create_week_bins, logged_week_bins, monday_of, stored_week_bins, to_grid
+from .signals import deferred_user_changes, user_data_changed
+from .sortlog import sortlog_buffer
+from .transitions import (
+    TASK_OPERATIONS, SUBTASK_OPERATIONS, start_task, pause_task, resume_task, complete_task,
+    update_task, delete_task, start_subtask, pause_subtask, resume_subtask, complete_subtask,
+)
 
 
 def jst_now():
@@ -56,75 +83,272 @@ def common_calculation(task):
 
 
 def calculate_score(type_name, calc_data):
-    """タイプ別スコア計算"""
-    if type_name == 'planner':
-        return (0.5 * calc_data['urgency'] + 
-                0.3 * calc_data['imp'] + 
-                calc_data['penalty'] + 
-                calc_data['overdue_bonus'])
-    elif type_name == 'sprinter':
-        return (0.7 * calc_data['urgency'] + 
-                0.2 * calc_data['not_started'] + 
-                0.1 * calc_data['imp'] + 
-                calc_data['step'] + 
-                calc_data['penalty'] + 
-                calc_data['overdue_bonus'])
-    elif type_name == 'flow':
-        return (0.3 * calc_data['short'] + 
-                0.2 * (1 - calc_data['imp']) + 
-                calc_data['penalty'] + 
-                calc_data['overdue_bonus'])
-    else:
-        raise ValueError(f"Unknown type: {type_name}")
+    """タイプ別スコア計算（SCORING_POLICIES の重みを使用）"""
+    return calculate_scores(type_name, {name: [value] for name, value in calc_data.items()})[0]
 
 
-def compute_sorted_tasks(user, type_name):
-    """ソート済みタスクを計算"""
-    try:
-        profile = UserProfile.objects.get(user=user)
-    except UserProfile.DoesNotExist:
-        profile = UserProfile.objects.create(user=user)
+def live_tasks(user, cutoff):
+    """アーカイブ対象（完了済みで cutoff より前に完了）を除いたタスク"""
+    return Task.objects.filter(user=user).exclude(status='done', completed_at__lt=cutoff)
+
+
+def archived_tasks(user, cutoff):
+    """アーカイブ済みタスク（完了が新しい順）"""
+    return (Task.objects.filter(user=user, status='done', completed_at__lt=cutoff)
+            .order_by('-completed_at', '-id'))
+
+
+def sort_key(item):
+    """ソート順のキー（完了済みは末尾）"""
+    task, score, calc_data = item
+    if task.status == 'done':
+        return (2, 0, 0, 0, 0, 0)
     
-    cutoff = jst_now() - timezone.timedelta(days=profile.archive_after_days)
+    overdue_group = 0 if calc_data['overdue_days'] > 0 else 1
+    return (
+        overdue_group,        # 0=超過, 1=その他
+        -score,               # スコア降順
+        task.deadline,        # 締切昇順
+        -task.importance,     # 重要度降順
+        task.estimate_min,    # 見積昇順
+        -int(task.created_at.timestamp())  # 新しい順
+    )
+
+
+def score_tasks(user, type_name, profile=None):
+    """スコア付きタスクを計算（未ソート）し、結果の有効期限とともに返す"""
+    scored_by_type, valid_until = score_tasks_multi(user, [type_name], profile)
+    return scored_by_type[type_name], valid_until
+
+
+def score_tasks_multi(user, type_names, profile=None):
+    """複数タイプのスコア付きタスクを1回の読み込み・特徴量計算で求める（未ソート）"""
+    if profile is None:
+        profile, created = UserProfile.objects.get_or_create(user=user)
     
-    # タスクを取得（サブタスクも含む）
-    qs = (Task.objects.filter(user=user)
-          .prefetch_related(Prefetch('subtasks', queryset=SubTask.objects.order_by('order_index'))))
+    now = jst_now()
+    cutoff = now - timezone.timedelta(days=profile.archive_after_days)
     
-    # 親estimateは子合計で同期
+    # タスクを取得（アーカイブ済みは除外、サブタスクは表示するページ分だけ後で読む）
+    qs = live_tasks(user, cutoff)
+    
+    # 親estimateは子合計で同期（集計済みの値を使う）
     tasks = list(qs)
     for task in tasks:
-        subtasks = list(task.subtasks.all())
-        if subtasks:
-            task.estimate_min = sum(st.estimate_min for st in subtasks)
+        task.estimate_min = task.effective_estimate_min
+    
+    # 特徴量とスコアを列単位で一括計算
+    features = compute_features(tasks, now)
+    rows = feature_rows(features)
+    scored_by_type = {
+        type_name: list(zip(tasks, scores, rows))
+        for type_name, scores in calculate_scores_multi(type_names, features).items()
+    }
+    
+    valid_until = next_change_at(tasks, features, now, profile.archive_after_days)
+    return scored_by_type, valid_until
+
+
+def sorted_task_row(task, score):
+    """ソート結果の1行（SORTED_TASK_FIELDS の全フィールド）
+
+    キャッシュしてリクエスト間で共有するので、モデルのインスタンスではなく素の値にする。
+    """
+    return {name: field(task, score) for name, field in SORTED_TASK_FIELDS.items()}
+
+
+def to_sorted_rows(scored):
+    """[(task, score, calc_data), ...] を [(行, score, calc_data), ...] にする"""
+    return [(sorted_task_row(task, score), score, calc_data) for task, score, calc_data in scored]
+
+
+def compute_sorted_tasks(user, type_name):
+    """ソート済みタスク [(行, score, calc_data), ...] を計算（次の日数境界までキャッシュ）"""
+    return compute_sorted_tasks_with_expiry(user, type_name)[0]
+
+
+def compute_sorted_tasks_with_expiry(user, type_name):
+    """ソート済みタスクと、その結果が有効な期限を返す"""
+    return compute_sorted_tasks_multi(user, [type_name])[type_name]
+
+
+def compute_sorted_tasks_multi(user, type_names):
+    """複数タイプのソート済みタスクを {タイプ: (ソート済み, 有効期限)} で返す
+
+    キャッシュ（変更カウンタ単位）にないタイプだけを、1回の特徴量計算でまとめて求める。
+    """
+    profile, created = UserProfile.objects.get_or_create(user=user)
+    version = profile.data_version
+    results = {}
+    missing = []
+    for type_name in type_names:
+        entry = sorted_cache.get_entry(user.id, type_name, version)
+        if entry is not None:
+            valid_until, scored = entry
+            results[type_name] = (scored, valid_until)
+        else:
+            missing.append(type_name)
+    
+    if missing:
+        generation = sorted_cache.generation(user.id)
+        scored_by_type, valid_until = score_tasks_multi(user, missing, profile)
+        for type_name, scored in scored_by_type.items():
+            scored.sort(key=sort_key)
+            rows = to_sorted_rows(scored)
+            sorted_cache.set(user.id, type_name, version, rows, valid_until, generation)
+            results[type_name] = (rows, valid_until)
+    return results
+
+
+def scored_cache_key(type_name):
+    """未ソートのスコア付き行をキャッシュするときのタイプ側のキー（ソート済みの結果と区別する）"""
+    return (type_name, 'scored')
+
+
+def select_sorted_tasks(user, type_name, limit, offset=0):
+    """上位 offset+limit 件だけをヒープで選び、該当ページと総件数を返す
+
+    全件ソートが必要ないため O(n log k) で済む。
+    キャッシュ済みの全件ソート結果があればそれを切り出す。なければスコア付きの行を
+    ソートキーとともに（未ソートのまま）キャッシュし、ページごとにそこからヒープで選ぶ。
+    """
+    profile, created = UserProfile.objects.get_or_create(user=user)
+    version = profile.data_version
+    entry = sorted_cache.peek(user.id, type_name, version)
+    if entry is not None:
+        rows = entry[1]
+        return rows[offset:offset + limit], len(rows)
+    
+    key = scored_cache_key(type_name)
+    keyed = sorted_cache.get(user.id, key, version)
+    if keyed is None:
+        generation = sorted_cache.generation(user.id)
+        scored, valid_until = score_tasks(user, type_name, profile)
+        keyed = [(sort_key(item), row, score, calc_data)
+                 for item, (row, score, calc_data) in zip(scored, to_sorted_rows(scored))]
+        sorted_cache.set(user.id, key, version, keyed, valid_until, generation)
+    top = heapq.nsmallest(offset + limit, keyed, key=itemgetter(0))
+    return [(row, score, calc_data) for _, row, score, calc_data in top[offset:]], len(keyed)
+
+
+def store_ranking(user_id, type_name, ranked, valid_until, version):
+    """ソート結果 [(task_id, score), ...] を TaskRanking に保存（既存の同タイプ分は置き換え）
+
+    version は計算前に読んだ UserProfile.data_version。計算中に書き込みがあって
+    変更カウンタが進んでいた場合は古い結果なので保存せず False を返す。
+    """
+    now = timezone.now()
+    rows = [
+        TaskRanking(user_id=user_id, type=type_name, task_id=task_id, rank=rank, score=score,
+                    valid_until=valid_until, data_version=version, computed_at=now)
+        for rank, (task_id, score) in enumerate(ranked)
+    ]
+    with transaction.atomic():
+        current = (UserProfile.objects.select_for_update()
+                   .filter(user_id=user_id).values_list('data_version', flat=True).first())
+        if current != version:
+            return False
+        TaskRanking.objects.filter(user_id=user_id, type=type_name).delete()
+        TaskRanking.objects.bulk_create(rows, batch_size=500)
+    return True
+
+
+def fresh_rankings(user, type_name):
+    """有効期限内で、保存後に書き込みのない（変更カウンタが一致する）TaskRanking"""
+    return TaskRanking.objects.filter(
+        user=user, type=type_name, valid_until__gt=timezone.now(),
+        data_version=F('user__userprofile__data_version'),
+    )
+
+
+def compute_sorted_tasks_db(user, type_name, limit=None, offset=0, with_total=False):
+    """ソート済みタスクをデータベース側で計算（annotate + ORDER BY + LIMIT）
+
+    with_total=True の場合は (ページ, 総件数) を返す。
+    """
+    profile, created = UserProfile.objects.get_or_create(user=user)
+    now = jst_now()
+    cutoff = now - timezone.timedelta(days=profile.archive_after_days)
+    
+    # 親estimateは子合計で同期（集計済みの値を使う）
+    estimate = Case(When(subtask_count__gt=0, then=F('subtask_estimate_total')),
+                    default=F('estimate_min'))
+    
+    qs = (live_tasks(user, cutoff)
+          .annotate(**feature_annotations(now, estimate))
+          .annotate(score=score_expression(type_name))
+          .annotate(**sort_annotations())
+          .order_by(*SORT_ORDER))
+    page_qs = qs[offset:] if limit is None else qs[offset:offset + limit]
     
     scored = []
-    for task in tasks:
-        # 完了済みでアーカイブ期間を過ぎたものは除外
-        if task.completed_at and task.completed_at < cutoff:
-            continue
-        
-        calc_data = common_calculation(task)
-        score = calculate_score(type_name, calc_data)
-        scored.append((task, score, calc_data))
+    for task in page_qs:
+        task.estimate_min = task.effective_estimate
+        calc_data = {name: getattr(task, name) for name in FEATURE_NAMES}
+        scored.append((sorted_task_row(task, task.score), task.score, calc_data))
     
-    def sort_key(item):
-        task, score, calc_data = item
-        if task.status == 'done':
-            return (2, 0, 0, 0, 0, 0)
-        
-        overdue_group = 0 if calc_data['overdue_days'] > 0 else 1
-        return (
-            overdue_group,        # 0=超過, 1=その他
-            -score,               # スコア降順
-            task.deadline,        # 締切昇順
-            -task.importance,     # 重要度降順
-            task.estimate_min,    # 見積昇順
-            -int(task.created_at.timestamp())  # 新しい順
-        )
+    if not with_total:
+        return scored
+    if limit is None or len(scored) < limit and (scored or offset == 0):
+        total = offset + len(scored)
+    else:
+        total = qs.count()
+    return scored, total
+
+
+def load_ranking(user, type_name, limit=None, offset=0):
+    """保存済みの TaskRanking からソート済みタスクを取得
+
+    有効期限切れ、または保存後に書き込みがあった（変更カウンタが進んだ）場合は None を返す。
+    """
+    qs = (fresh_rankings(user, type_name)
+          .select_related('task')
+          .order_by('rank'))
+    rows = list(qs[offset:] if limit is None else qs[offset:offset + limit])
+    if not rows:
+        return None
+    
+    scored = []
+    for row in rows:
+        task = row.task
+        task.estimate_min = task.effective_estimate_min
+        scored.append((sorted_task_row(task, row.score), row.score, None))
     
-    scored.sort(key=sort_key)
-    return scored
+    if limit is None or len(scored) < limit:
+        total = offset + len(scored)
+    else:
+        total = qs.count()
+    return scored, total
+
+
+def get_sorted_tasks(user, type_name, limit=None, offset=0):
+    """ソート済みタスクを取得
+
+    保存済みの TaskRanking が有効ならそれを使い、なければ設定されたバックエンド
+    （PERSK_SORT_BACKEND）で計算する。(ページ, 総件数) を返す。limit を省略すると全件。
+    """
+    stored = load_ranking(user, type_name, limit=limit, offset=offset)
+    if stored is not None:
+        return stored
+    if getattr(settings, 'PERSK_SORT_BACKEND', 'python') == 'database':
+        return compute_sorted_tasks_db(user, type_name, limit=limit, offset=offset, with_total=True)
+    if limit is None:
+        scored = compute_sorted_tasks(user, type_name)
+        return scored[offset:], len(scored)
+    return select_sorted_tasks(user, type_name, limit, offset)
+
+
+def get_sorted_tasks_multi(user, type_names, limit=None, offset=0):
+    """複数タイプのソート済みタスクを {タイプ: (ページ, 総件数)} で返す
+
+    各タイプとも get_sorted_tasks() と同じ経路（保存済み TaskRanking、なければ PERSK_SORT_BACKEND）で取得する。
+    python バックエンドで計算が必要なタイプが複数あれば、先に1回の特徴量計算でまとめてキャッシュに載せる。
+    """
+    if getattr(settings, 'PERSK_SORT_BACKEND', 'python') != 'database':
+        missing = [type_name for type_name in type_names if not fresh_rankings(user, type_name).exists()]
+        if len(missing) > 1:
+            compute_sorted_tasks_multi(user, missing)
+    return {type_name: get_sorted_tasks(user, type_name, limit=limit, offset=offset) for type_name in type_names}
 
 
 @login_required
@@ -180,42 +404,276 @@ def signup_view(request):
     return render(request, 'registration/signup.html', {'form': form})
 
 
+# 条件付きGET（ETag）
+
+def get_data_version(user):
+    """ユーザー別の変更カウンタ（プロフィールがなければ作成）"""
+    profile, created = UserProfile.objects.get_or_create(user=user)
+    return profile.data_version
+
+
+def make_etag(request, *parts):
+    """ユーザー・変更カウンタ等とクエリ文字列から ETag を作る"""
+    raw = '|'.join([str(request.user.id), *map(str, parts), request.GET.urlencode()])
+    return hashlib.md5(raw.encode()).hexdigest()
+
+
+def tasks_etag(request):
+    return make_etag(request, 'tasks', get_data_version(request.user))
+
+
+def profile_etag(request):
+    return make_etag(request, 'profile', get_data_version(request.user))
+
+
+def sorted_tasks_etag(request):
+    """ソート結果の有効期限が分かる場合のみ ETag を返す"""
+    version = get_data_version(request.user)
+    types_param = request.GET.get('types')
+    type_names = types_param.split(',') if types_param else [request.GET.get('type', 'planner')]
+    
+    expiries = []
+    for type_name in type_names:
+        entry = (sorted_cache.peek(request.user.id, type_name, version)
+                 or sorted_cache.peek(request.user.id, scored_cache_key(type_name), version))
+        if entry is not None:
+            expiries.append(entry[0])
+            continue
+        valid_until = fresh_rankings(request.user, type_name).values_list('valid_until', flat=True).first()
+        if valid_until is None:
+            return None
+        expiries.append(valid_until)
+    return make_etag(request, 'sorted', version, min(expiries).isoformat())
+
+
+# メトリクスの集計期間（今日を含む日数、JST の日付単位）
+METRICS_RANGE_DAYS = {'day': 1, 'week': 7, 'month': 30}
+
+
+def metrics_start_day(range_type, today):
+    """メトリクス集計の開始日（JST）"""
+    return today - timedelta(days=METRICS_RANGE_DAYS.get(range_type, 1) - 1)
+
+
+def metrics_etag(request):
+    """変更カウンタ + 日付（集計期間は日付単位なので日付が変わるまで結果は変わらない）"""
+    version = get_data_version(request.user)
+    return make_etag(request, 'metrics', version, timezone.localdate())
+
+
 # API Views
 
+# api_tasks で1回に読み込むタスク数（サブタスクはチャンクごとに1クエリで先読み）
+TASKS_CHUNK_SIZE = 500
+
+
+def serialize_subtask(subtask):
+    """タスク一覧用のサブタスク"""
+    return {
+        'id': subtask.id,
+        'title': subtask.title,
+        'done': subtask.done,
+        'status': subtask.status,
+        'started_at': subtask.started_at.isoformat() if subtask.started_at else None,
+        'completed_at': subtask.completed_at.isoformat() if subtask.completed_at else None
+    }
+
+
+def _isoformat(dt):
+    return dt.isoformat() if dt else None
+
+
+# タスク一覧で返せるフィールド（fields= で選択）: 名前 -> 値の取り出し
+TASK_FIELDS = {
+    'id': lambda task: task.id,
+    'title': lambda task: task.title,
+    'deadline': lambda task: _isoformat(task.deadline),
+    'estimate_min': lambda task: task.estimate_min,
+    'tags': lambda task: task.tags,
+    'importance': lambda task: task.importance,
+    'status': lambda task: task.status,
+    'shared': lambda task: task.shared,
+    'started_at': lambda task: _isoformat(task.started_at),
+    'completed_at': lambda task: _isoformat(task.completed_at),
+}
+
+# ソート済み一覧の親タスク行で返せるフィールド
+SORTED_TASK_FIELDS = {
+    'id': lambda task, score: task.id,
+    'parent_id': lambda task, score: None,
+    'title': lambda task, score: task.title,
+    'status': lambda task, score: task.status,
+    'deadline': lambda task, score: task.deadline.isoformat(),
+    'estimate_min': lambda task, score: task.estimate_min,
+    'importance': lambda task, score: task.importance,
+    'tags': lambda task, score: task.tags,
+    'shared': lambda task, score: task.shared,
+    'score': lambda task, score: round(score, 3),
+    'has_subtasks': lambda task, score: task.subtask_count > 0,
+}
+
+
+def parse_sparse_fields(request, available, required=('id',)):
+    """fields= と include= を解釈し (フィールド一覧, サブタスクを含めるか) を返す
+
+    fields を省略すると全フィールド。include を省略した場合、
+    サブタスクは fields も省略されたとき（従来どおりの全量）だけ含める。
+    """
+    fields_param = request.GET.get('fields')
+    if fields_param:
+        fields = [name for name in fields_param.split(',') if name]
+        unknown = [name for name in fields if name not in available]
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+        fields = [name for name in required if name not in fields] + fields
+    else:
+        fields = list(available)
+    
+    if 'include' in request.GET:
+        include_subtasks = 'subtasks' in request.GET['include'].split(',')
+    else:
+        include_subtasks = not fields_param
+    return fields, include_subtasks
+
+
+def serialize_task(task, include_subtasks=True, fields=None):
+    """タスク一覧用のタスク（既定では全フィールド＋サブタスク）"""
+    task_data = {name: TASK_FIELDS[name](task) for name in (fields or TASK_FIELDS)}
+    if include_subtasks:
+        task_data['subtasks'] = [serialize_subtask(subtask) for subtask in task.subtasks.all()]
+    return task_data
+
+
+def encode_sync_token(seq, issued_at):
+    """同期トークン（順序番号 + 発行時刻。発行時刻は削除記録の保持期間の判定に使う）"""
+    return base64.urlsafe_b64encode(f'{seq}:{issued_at.isoformat()}'.encode()).decode()
+
+
+def decode_sync_token(token):
+    seq, issued_at = base64.urlsafe_b64decode(token.encode()).decode().split(':', 1)
+    issued_at = datetime.fromisoformat(issued_at)
+    if timezone.is_naive(issued_at):
+        raise ValueError('Invalid token')
+    return int(seq), issued_at
+
+
 @login_required
 @require_http_methods(["GET"])
-def api_tasks(request):
-    """タスク一覧取得"""
-    tasks = Task.objects.filter(user=request.user)
-    tasks_data = []
-    
-    for task in tasks:
-        task_data = {
-            'id': task.id,
-            'title': task.title,
-            'deadline': task.deadline.isoformat() if task.deadline else None,
-            'estimate_min': task.estimate_min,
-            'tags': task.tags,
-            'importance': task.importance,
-            'status': task.status,
-            'shared': task.shared,
-            'started_at': task.started_at.isoformat() if task.started_at else None,
-            'completed_at': task.completed_at.isoformat() if task.completed_at else None,
+def api_tasks_changes(request):
+    """前回の同期トークン以降に変更・削除されたタスク／サブタスクを取得
+
+    トークンはユーザー別の順序番号（書き込みごとに進む UserProfile.data_version）で、
+    各行には書き込み時の値が change_seq として振られる。時刻ではなく順序番号で比べるので、
+    読み取りより前に書き始めて後からコミットされた行も次回の同期で取りこぼさない。
+    順序番号が未確定（NULL）の行は確定後にもう一度返る。
+    since を省略した場合、または削除記録の保持期間より古い場合は
+    全件を返し reset=True とする（クライアントは手元の複製を置き換える）。
+    """
+    try:
+        now = timezone.now()
+        retention = timedelta(days=getattr(settings, 'PERSK_TOMBSTONE_RETENTION_DAYS', 30))
+        # 行より先に順序番号を読む（これ以下の番号の行はすべてコミット済み）
+        version = get_data_version(request.user)
+        since = None
+        if request.GET.get('since'):
+            since, issued_at = decode_sync_token(request.GET['since'])
+            if issued_at < now - retention or since > version:
+                since = None
+        reset = since is None
+        
+        tasks = Task.objects.filter(user=request.user)
+        subtasks = SubTask.objects.filter(task__user=request.user)
+        tombstones = ChangeTombstone.objects.none()
+        if not reset:
+            changed = Q(change_seq__isnull=True) | Q(change_seq__gt=since, change_seq__lte=version)
+            tasks = tasks.filter(changed)
+            subtasks = subtasks.filter(changed)
+            tombstones = ChangeTombstone.objects.filter(changed, user=request.user)
+        
+        deleted = {'tasks': [], 'subtasks': []}
+        for kind, object_id in tombstones.values_list('kind', 'object_id'):
+            deleted[f'{kind}s'].append(object_id)
+        
+        return JsonResponse({
+            'token': encode_sync_token(version, now),
+            'reset': reset,
+            'tasks': [serialize_task(task, include_subtasks=False) for task in tasks],
             'subtasks': [
-                {
-                    'id': subtask.id,
-                    'title': subtask.title,
-                    'done': subtask.done,
-                    'status': subtask.status,
-                    'started_at': subtask.started_at.isoformat() if subtask.started_at else None,
-                    'completed_at': subtask.completed_at.isoformat() if subtask.completed_at else None
-                }
-                for subtask in task.subtasks.all()
-            ]
-        }
-        tasks_data.append(task_data)
+                dict(serialize_subtask(subtask), task_id=subtask.task_id,
+                     estimate_min=subtask.estimate_min, order_index=subtask.order_index)
+                for subtask in subtasks
+            ],
+            'deleted': deleted
+        })
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+
+def stream_json_array(key, items):
+    """{"key": [...]} を要素ごとに書き出すジェネレータ"""
+    yield '{"%s": [' % key
+    for i, item in enumerate(items):
+        yield (',' if i else '') + json.dumps(item, cls=DjangoJSONEncoder)
+    yield ']}'
+
+
+@login_required
+@require_http_methods(["GET"])
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=tasks_etag)
+def api_tasks(request):
+    """タスク一覧取得（チャンク単位で読み込みながらストリーミング）
+
+    fields=id,title,status で返すフィールドを絞り、include=subtasks でサブタスクを含める。
+    選ばれなかったカラムは読み込まない。
+    """
+    try:
+        fields, include_subtasks = parse_sparse_fields(request, TASK_FIELDS)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
     
-    return JsonResponse({'tasks': tasks_data})
+    tasks = Task.objects.filter(user=request.user).only(*fields)
+    if include_subtasks:
+        tasks = tasks.prefetch_related('subtasks')
+    tasks = tasks.iterator(chunk_size=TASKS_CHUNK_SIZE)
+    return StreamingHttpResponse(
+        stream_json_array('tasks', (
+            serialize_task(task, include_subtasks=include_subtasks, fields=fields) for task in tasks
+        )),
+        content_type='application/json'
+    )
+
+
+@login_required
+@require_http_methods(["GET"])
+def api_tasks_archive(request):
+    """アーカイブ済みタスク一覧取得（ページング）"""
+    try:
+        limit = int(request.GET.get('limit', 50))
+        offset = int(request.GET.get('offset', 0))
+        if limit <= 0 or offset < 0:
+            return JsonResponse({'error': 'Invalid limit/offset'}, status=400)
+        
+        profile, created = UserProfile.objects.get_or_create(user=request.user)
+        cutoff = jst_now() - timedelta(days=profile.archive_after_days)
+        
+        qs = archived_tasks(request.user, cutoff)
+        total = qs.count()
+        page = qs.prefetch_related(
+            Prefetch('subtasks', queryset=SubTask.objects.order_by('order_index'))
+        )[offset:offset + limit]
+        
+        # タスク一覧と同じ形（全フィールド＋サブタスク）
+        tasks_data = [serialize_task(task) for task in page]
+        
+        next_offset = offset + len(tasks_data)
+        return JsonResponse({
+            'tasks': tasks_data,
+            'total': total,
+            'next_offset': next_offset if next_offset < total else None
+        })
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=400)
 
 
 @login_required
@@ -244,21 +702,7 @@ def api_task_update(request, task_id):
     try:
         task = get_object_or_404(Task, id=task_id, user=request.user)
         data = json.loads(request.body)
-        
-        if 'title' in data:
-            task.title = data['title']
-        if 'deadline' in data:
-            task.deadline = datetime.fromisoformat(data['deadline']) if data['deadline'] else None
-        if 'estimate_min' in data:
-            task.estimate_min = data['estimate_min']
-        if 'tags' in data:
-            task.tags = data['tags']
-        if 'importance' in data:
-            task.importance = data['importance']
-        if 'status' in data:
-            task.status = data['status']
-        
-        task.save()
+        update_task(request.user, task, timezone.now(), data)
         return JsonResponse({'ok': True})
     except Exception as e:
         return JsonResponse({'ok': False, 'error': str(e)}, status=400)
@@ -270,7 +714,7 @@ def api_task_delete(request, task_id):
     """タスク削除"""
     try:
         task = get_object_or_404(Task, id=task_id, user=request.user)
-        task.delete()
+        delete_task(request.user, task, timezone.now())
         return JsonResponse({'ok': True})
     except Exception as e:
         return JsonResponse({'ok': False, 'error': str(e)}, status=400)
@@ -282,13 +726,8 @@ def api_task_start(request, task_id):
     """タスク開始"""
     try:
         task = get_object_or_404(Task, id=task_id, user=request.user)
-        now = timezone.now()
-        
-        task.status = 'doing'
-        task.started_at = now
-        task.save()
-        
-        return JsonResponse({'ok': True, 'started_at': now.isoformat()})
+        result = start_task(request.user, task, timezone.now())
+        return JsonResponse({'ok': True, **result})
     except Exception as e:
         return JsonResponse({'ok': False, 'error': str(e)}, status=400)
 
@@ -299,25 +738,8 @@ def api_task_pause(request, task_id):
     """タスク一時停止"""
     try:
         task = get_object_or_404(Task, id=task_id, user=request.user)
-        now = timezone.now()
-        
-        seconds = 0  # 初期化
-        if task.started_at:
-            # FocusLogを作成
-            seconds = int((now - task.started_at).total_seconds())
-            FocusLog.objects.create(
-                user=request.user,
-                task=task,
-                started_at=task.started_at,
-                stopped_at=now,
-                seconds=seconds
-            )
-        
-        task.status = 'paused'
-        task.started_at = None
-        task.save()
-        
-        return JsonResponse({'ok': True, 'logged_seconds': seconds})
+        result = pause_task(request.user, task, timezone.now())
+        return JsonResponse({'ok': True, **result})
     except Exception as e:
         return JsonResponse({'ok': False, 'error': str(e)}, status=400)
 
@@ -328,28 +750,8 @@ def api_task_resume(request, task_id):
     """タスク再開"""
     try:
         task = get_object_or_404(Task, id=task_id, user=request.user)
-        now = timezone.now()
-
-        elapsed_seconds = 0  # 初期化
-        if task.started_at:
-            elapsed_seconds = int((now - task.started_at).total_seconds())
-            FocusLog.objects.create(
-                user=request.user,
-                task=task,
-                started_at=task.started_at,
-                stopped_at=now,
-                seconds=elapsed_seconds
-            )
-        
-        task.status = 'doing'
-        task.started_at = now
-        task.save()
-        
-        return JsonResponse({
-            'ok': True, 
-            'started_at': now.isoformat(),
-            'logged_seconds': elapsed_seconds
-        })
+        result = resume_task(request.user, task, timezone.now())
+        return JsonResponse({'ok': True, **result})
     except Exception as e:
         return JsonResponse({'ok': False, 'error': str(e)}, status=400)
 
@@ -360,25 +762,97 @@ def api_task_complete(request, task_id):
     """タスク完了"""
     try:
         task = get_object_or_404(Task, id=task_id, user=request.user)
-        now = timezone.now()
-        
-        # 実行中ならログを作成
-        if task.status == 'doing' and task.started_at:
-            seconds = int((now - task.started_at).total_seconds())
-            FocusLog.objects.create(
-                user=request.user,
-                task=task,
-                started_at=task.started_at,
-                stopped_at=now,
-                seconds=seconds
-            )
-        
-        task.status = 'done'
-        task.completed_at = now
-        task.started_at = None
-        task.save()
+        result = complete_task(request.user, task, timezone.now())
+        return JsonResponse({'ok': True, **result})
+    except Exception as e:
+        return JsonResponse({'ok': False, 'error': str(e)}, status=400)
+
+
+@login_required
+@require_http_methods(["GET"])
+def api_active_timer(request):
+    """実行中タイマー取得（タスク一覧を読まずにタイマー表示を復元する）
+
+    active は最後に開始したタイマー、timers は実行中のタイマー全件（新しい順）。
+    """
+    try:
+        timers = []
+        for timer in (ActiveTimer.objects
+                      .filter(user=request.user)
+                      .select_related('task', 'subtask')
+                      .order_by('-started_at', '-id')):
+            target = timer.subtask or timer.task
+            timers.append({
+                'task_id': timer.task_id,
+                'subtask_id': timer.subtask_id,
+                'title': target.title,
+                'started_at': timer.started_at.isoformat(),
+                'total_focus_seconds': target.total_focus_seconds,
+            })
+        return JsonResponse({
+            'ok': True,
+            'active': timers[0] if timers else None,
+            'timers': timers,
+            'server_time': timezone.now().isoformat(),
+        })
+    except Exception as e:
+        return JsonResponse({'ok': False, 'error': str(e)}, status=400)
+
+
+# /api/commands/ で一度に受け付ける操作数
+MAX_COMMANDS = 100
+
+
+@login_required
+@require_http_methods(["POST"])
+def api_commands(request):
+    """タスク・サブタスク操作の一括実行
+
+    {"operations": [{"op": "task.pause", "task_id": 1}, {"op": "subtask.start", "subtask_id": 2}, ...]}
+    を順に1トランザクションで実行し、操作ごとの結果を返す。
+    1件でも失敗した場合は全体を取り消し、失敗した操作の index を返す。
+    """
+    try:
+        operations = json.loads(request.body).get('operations', [])
+        if not operations or len(operations) > MAX_COMMANDS:
+            return JsonResponse({'ok': False, 'error': f'operations must have 1-{MAX_COMMANDS} items'}, status=400)
+        for op in operations:
+            if op.get('op') not in TASK_OPERATIONS and op.get('op') not in SUBTASK_OPERATIONS:
+                return JsonResponse({'ok': False, 'error': f"Unknown op: {op.get('op')}"}, status=400)
+        
+        # 権限確認は対象ごとに1回（まとめて取得）
+        task_ids = {op['task_id'] for op in operations if op['op'] in TASK_OPERATIONS}
+        subtask_ids = {op['subtask_id'] for op in operations if op['op'] in SUBTASK_OPERATIONS}
+        tasks = {task.id: task for task in Task.objects.filter(user=request.user, id__in=task_ids)}
+        subtasks = {subtask.id: subtask for subtask in
+                    SubTask.objects.filter(task__user=request.user, id__in=subtask_ids)}
+        missing = sorted(task_ids - tasks.keys()) + sorted(subtask_ids - subtasks.keys())
+        if missing:
+            return JsonResponse({'ok': False, 'error': f'Not found: {missing}'}, status=404)
         
-        return JsonResponse({'ok': True, 'completed_at': now.isoformat()})
+        now = timezone.now()
+        results = []
+        index = 0
+        try:
+            # キャッシュ破棄・変更カウンタの加算はユーザーごとに最後の1回だけ
+            with transaction.atomic(), deferred_user_changes():
+                for index, op in enumerate(operations):
+                    if op['op'] in TASK_OPERATIONS:
+                        target = tasks.get(op['task_id'])
+                        if target is None:
+                            raise ValueError(f"Task {op['task_id']} was deleted")
+                        args = (op.get('data', {}),) if op['op'] == 'task.update' else ()
+                        result = TASK_OPERATIONS[op['op']](request.user, target, now, *args)
+                        if op['op'] == 'task.delete':
+                            del tasks[op['task_id']]
+                    else:
+                        target = subtasks[op['subtask_id']]
+                        result = SUBTASK_OPERATIONS[op['op']](request.user, target, now)
+                    results.append({'ok': True, **result})
+        except Exception as e:
+            return JsonResponse({'ok': False, 'index': index, 'error': str(e)}, status=400)
+        
+        return JsonResponse({'ok': True, 'results': results})
     except Exception as e:
         return JsonResponse({'ok': False, 'error': str(e)}, status=400)
 
@@ -386,32 +860,50 @@ def api_task_complete(request, task_id):
 @login_required
 @require_http_methods(["POST"])
 def api_subtasks_bulk_upsert(request, task_id):
-    """サブタスク一括更新"""
+    """サブタスク一括更新（件数によらず一定回数のクエリで処理）"""
     try:
         task = get_object_or_404(Task, id=task_id, user=request.user)
         data = json.loads(request.body)
+        subtasks_data = data.get('subtasks', [])
         
-        items = []
-        for subtask_data in data.get('subtasks', []):
+        # 既存サブタスクはまとめて取得し、このタスクのものでない id は一括で拒否
+        ids = {subtask_data['id'] for subtask_data in subtasks_data if 'id' in subtask_data}
+        existing = {subtask.id: subtask for subtask in task.subtasks.filter(id__in=ids)}
+        unknown = sorted(ids - existing.keys())
+        if unknown:
+            return JsonResponse({'ok': False, 'error': f'Unknown subtask ids: {unknown}'}, status=400)
+        
+        now = timezone.now()
+        subtasks = []
+        created = []
+        for subtask_data in subtasks_data:
             if 'id' in subtask_data:
                 # 更新
-                subtask = get_object_or_404(SubTask, id=subtask_data['id'], task=task)
+                subtask = existing[subtask_data['id']]
                 subtask.title = subtask_data.get('title', subtask.title)
                 subtask.done = subtask_data.get('done', subtask.done)
-                subtask.save()
+                subtask.updated_at = now  # bulk_update では auto_now が効かない
+                subtask.change_seq = None  # 順序番号は user_data_changed で確定
             else:
                 # 新規作成
-                subtask = SubTask.objects.create(
+                subtask = SubTask(
                     task=task,
                     title=subtask_data.get('title', ''),
                     done=subtask_data.get('done', False)
                 )
-            
-            items.append({
-                'id': subtask.id,
-                'done': subtask.done
-            })
-        
+                created.append(subtask)
+            subtasks.append(subtask)
+        
+        with transaction.atomic():
+            if existing:
+                SubTask.objects.bulk_update(existing.values(), ['title', 'done', 'updated_at', 'change_seq'])
+            if created:
+                SubTask.objects.bulk_create(created)
+            # 一括処理はシグナルを通らないので、集計と変更通知をここで1回だけ行う
+            refresh_subtask_totals([task.id])
+            user_data_changed(request.user.id)
+        
+        items = [{'id': subtask.id, 'done': subtask.done} for subtask in subtasks]
         return JsonResponse({'ok': True, 'items': items})
     except Exception as e:
         return JsonResponse({'ok': False, 'error': str(e)}, status=400)
@@ -423,13 +915,8 @@ def api_subtask_start(request, subtask_id):
     """サブタスク開始"""
     try:
         subtask = get_object_or_404(SubTask, id=subtask_id, task__user=request.user)
-        now = timezone.now()
-        
-        subtask.status = 'doing'
-        subtask.started_at = now
-        subtask.save()
-        
-        return JsonResponse({'ok': True, 'started_at': now.isoformat()})
+        result = start_subtask(request.user, subtask, timezone.now())
+        return JsonResponse({'ok': True, **result})
     except Exception as e:
         return JsonResponse({'ok': False, 'error': str(e)}, status=400)
 
@@ -440,25 +927,8 @@ def api_subtask_pause(request, subtask_id):
     """サブタスク一時停止"""
     try:
         subtask = get_object_or_404(SubTask, id=subtask_id, task__user=request.user)
-        now = timezone.now()
-        
-        seconds = 0  # 初期化
-        if subtask.started_at:
-            # FocusLogを作成
-            seconds = int((now - subtask.started_at).total_seconds())
-            FocusLog.objects.create(
-                user=request.user,
-                subtask=subtask,
-                started_at=subtask.started_at,
-                stopped_at=now,
-                seconds=seconds
-            )
-        
-        subtask.status = 'paused'
-        # started_atをNoneに設定しない（経過時間を維持するため）
-        subtask.save()
-        
-        return JsonResponse({'ok': True, 'logged_seconds': seconds})
+        result = pause_subtask(request.user, subtask, timezone.now())
+        return JsonResponse({'ok': True, **result})
     except Exception as e:
         return JsonResponse({'ok': False, 'error': str(e)}, status=400)
 
@@ -469,13 +939,8 @@ def api_subtask_resume(request, subtask_id):
     """サブタスク再開"""
     try:
         subtask = get_object_or_404(SubTask, id=subtask_id, task__user=request.user)
-        now = timezone.now()
-        
-        subtask.status = 'doing'
-        # started_atは既存の値を維持（経過時間を保持するため）
-        subtask.save()
-        
-        return JsonResponse({'ok': True, 'started_at': subtask.started_at.isoformat() if subtask.started_at else now.isoformat()})
+        result = resume_subtask(request.user, subtask, timezone.now())
+        return JsonResponse({'ok': True, **result})
     except Exception as e:
         return JsonResponse({'ok': False, 'error': str(e)}, status=400)
 
@@ -486,25 +951,8 @@ def api_subtask_complete(request, subtask_id):
     """サブタスク完了"""
     try:
         subtask = get_object_or_404(SubTask, id=subtask_id, task__user=request.user)
-        now = timezone.now()
-        
-        # 実行中ならログを作成
-        if subtask.status == 'doing' and subtask.started_at:
-            seconds = int((now - subtask.started_at).total_seconds())
-            FocusLog.objects.create(
-                user=request.user,
-                subtask=subtask,
-                started_at=subtask.started_at,
-                stopped_at=now,
-                seconds=seconds
-            )
-        
-        subtask.status = 'done'
-        subtask.completed_at = now
-        subtask.started_at = None
-        subtask.save()
-        
-        return JsonResponse({'ok': True, 'completed_at': now.isoformat()})
+        result = complete_subtask(request.user, subtask, timezone.now())
+        return JsonResponse({'ok': True, **result})
     except Exception as e:
         return JsonResponse({'ok': False, 'error': str(e)}, status=400)
 
@@ -552,7 +1000,7 @@ def api_diagnosis_submit(request):
         profile, created = UserProfile.objects.get_or_create(user=request.user)
         profile.main_type = main_type
         profile.sub_type = sub_type
-        profile.save()
+        profile.save(update_fields=['main_type', 'sub_type'])
         
         return JsonResponse({
             'ok': True,
@@ -565,6 +1013,8 @@ def api_diagnosis_submit(request):
 
 @login_required
 @require_http_methods(["GET"])
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=profile_etag)
 def api_profile(request):
     """プロフィール取得"""
     try:
@@ -588,64 +1038,54 @@ def api_profile_update(request):
         
         if 'settings' in data:
             profile.settings_json = data['settings']
-        
-        profile.save()
+            profile.save(update_fields=['settings_json'])
         return JsonResponse({'ok': True})
     except Exception as e:
         return JsonResponse({'ok': False, 'error': str(e)}, status=400)
 
 
+def metrics_summary(user_id, range_type, today):
+    """メトリクスの計算"""
+    start_day = metrics_start_day(range_type, today)
+    
+    # フォーカス時間の合計（日別集計から）
+    total_seconds = focus_daily_totals(user_id, start_day, today)['total_seconds']
+    
+    # 仮の目標値（8時間 = 28800秒）
+    target_seconds = 28800
+    
+    # ストリーク（連続日数、JST の今日まで）
+    streak_days = current_streak(user_id, today)
+    
+    return {
+        'ring': {
+            'target': target_seconds,
+            'actual': total_seconds
+        },
+        'streak': {
+            'days': streak_days
+        },
+        'heatmap': []  # 仮実装
+    }
+
+
 @login_required
 @require_http_methods(["GET"])
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=metrics_etag)
 def api_metrics_summary(request):
     """メトリクス取得"""
     try:
         range_type = request.GET.get('range', 'day')
-        now = timezone.now()
-        
-        if range_type == 'day':
-            start_date = now.replace(hour=0, minute=0, second=0, microsecond=0)
-        elif range_type == 'week':
-            start_date = now - timedelta(days=7)
-        elif range_type == 'month':
-            start_date = now - timedelta(days=30)
-        else:
-            start_date = now.replace(hour=0, minute=0, second=0, microsecond=0)
-        
-        # フォーカス時間の合計
-        focus_logs = FocusLog.objects.filter(
-            user=request.user,
-            started_at__gte=start_date
+        today = timezone.localdate()
+        # 同じユーザー×期間の同時リクエストは1回の計算結果を共有
+        # （ETag と同じく変更カウンタをキーに含め、別プロセスでの書き込み後は計算し直す）
+        version = get_data_version(request.user)
+        summary = metrics_cache.get_or_compute(
+            request.user.id, ('summary', range_type, today, version),
+            lambda: metrics_summary(request.user.id, range_type, today)
         )
-        total_seconds = sum(log.seconds for log in focus_logs)
-        
-        # 仮の目標値（8時間 = 28800秒）
-        target_seconds = 28800
-        
-        # ストリーク（連続日数）
-        streak_days = 0
-        current_date = now.date()
-        while True:
-            day_logs = FocusLog.objects.filter(
-                user=request.user,
-                started_at__date=current_date
-            )
-            if day_logs.exists():
-                streak_days += 1
-                current_date -= timedelta(days=1)
-            else:
-                break
-        
-        return JsonResponse({
-            'ring': {
-                'target': target_seconds,
-                'actual': total_seconds
-            },
-            'streak': {
-                'days': streak_days
-            },
-            'heatmap': []  # 仮実装
-        })
+        return JsonResponse(summary)
     except Exception as e:
         return JsonResponse({'ok': False, 'error': str(e)}, status=400)
 
@@ -657,17 +1097,11 @@ def api_task_focus_time(request, task_id):
     try:
         task = get_object_or_404(Task, id=task_id, user=request.user)
         
-        # このタスクのFocusLogから総フォーカス時間を計算
-        focus_logs = FocusLog.objects.filter(
-            user=request.user,
-            task=task
-        )
-        total_seconds = sum(log.seconds for log in focus_logs)
-        
+        # 累計フォーカス時間（FocusLog 作成時に加算済み）
         return JsonResponse({
             'ok': True,
             'task_id': task_id,
-            'total_seconds': total_seconds
+            'total_seconds': task.total_focus_seconds
         })
     except Exception as e:
         return JsonResponse({'ok': False, 'error': str(e)}, status=400)
@@ -675,66 +1109,150 @@ def api_task_focus_time(request, task_id):
 
 @login_required
 @require_http_methods(["GET"])
+def api_tasks_focus_time(request):
+    """複数タスクのフォーカス時間をまとめて取得
+
+    ids=1,2,3 で対象を絞る（省略時はユーザーの全タスク）。
+    サブタスクの累計フォーカス時間は親タスクに合算する。
+    """
+    try:
+        tasks = Task.objects.filter(user=request.user)
+        
+        ids_param = request.GET.get('ids')
+        if ids_param:
+            task_ids = [int(task_id) for task_id in ids_param.split(',') if task_id]
+            tasks = tasks.filter(id__in=task_ids)
+        
+        # 親タスク＋サブタスクの累計を1回の集計クエリで取得
+        totals = (tasks
+                  .annotate(subtask_seconds=Coalesce(Sum('subtasks__total_focus_seconds'), 0))
+                  .values('id', 'total_focus_seconds', 'subtask_seconds')
+                  .order_by())
+        
+        return JsonResponse({
+            'ok': True,
+            'focus_times': {
+                str(row['id']): row['total_focus_seconds'] + row['subtask_seconds'] for row in totals
+            }
+        })
+    except Exception as e:
+        return JsonResponse({'ok': False, 'error': str(e)}, status=400)
+
+
+def top_task_ids(user, type_name, page, offset, total, count=5):
+    """SortLog 用の全体の上位 count 件の ID
+
+    表示ページが先頭から count 件（または全件）を含んでいればそれを使い、
+    そうでなければ先頭ページを取り直す。
+    """
+    if offset == 0 and (len(page) >= count or len(page) == total):
+        top = page[:count]
+    else:
+        top, _ = get_sorted_tasks(user, type_name, limit=count)
+    return [row['id'] for row, _, _ in top]
+
+
+def serialize_sorted_tasks(scored_tasks, fields=None, include_subtasks=True):
+    """ソート済みの行をレスポンス用の行（親→子の順）に変換
+
+    キャッシュ済みの行は共有されているので変更せず、選んだフィールドを写す。
+    """
+    subtasks_by_task = defaultdict(list)
+    if include_subtasks:
+        # 表示するページのタスク分だけサブタスクを1回のクエリで読み込む
+        subtasks = (SubTask.objects
+                    .filter(task_id__in=[row['id'] for row, _, _ in scored_tasks])
+                    .order_by('order_index'))
+        for subtask in subtasks:
+            subtasks_by_task[subtask.task_id].append(subtask)
+    
+    tasks_data = []
+    for row, score, calc_data in scored_tasks:
+        task_data = {name: row[name] for name in (fields or SORTED_TASK_FIELDS)}
+        tasks_data.append(task_data)
+        
+        # サブタスクを追加
+        if not include_subtasks:
+            continue
+        for subtask in subtasks_by_task[row['id']]:
+            subtask_data = {
+                'id': subtask.id,
+                'parent_id': row['id'],
+                'title': subtask.title,
+                'status': subtask.status,
+                'estimate_min': subtask.estimate_min,
+                'order_index': subtask.order_index
+            }
+            tasks_data.append(subtask_data)
+    return tasks_data
+
+
+@login_required
+@require_http_methods(["GET"])
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=sorted_tasks_etag)
 def api_tasks_sorted(request):
-    """ソート済みタスク取得"""
+    """ソート済みタスク取得
+
+    types=planner,flow のように複数タイプを指定すると、全タイプの並びを orderings にまとめて返す
+    （各タイプの並びは type= で1タイプずつ取得した場合と同じ）。
+    """
     try:
-        type_name = request.GET.get('type', 'planner')
-        if type_name not in ['planner', 'sprinter', 'flow']:
+        types_param = request.GET.get('types')
+        type_names = types_param.split(',') if types_param else [request.GET.get('type', 'planner')]
+        if not all(type_name in SCORING_POLICIES for type_name in type_names):
             return JsonResponse({'error': 'Invalid type'}, status=400)
         
-        scored_tasks = compute_sorted_tasks(request.user, type_name)
-        
-        # レスポンス用データ構造を作成
-        tasks_data = []
-        for task, score, calc_data in scored_tasks:
-            task_data = {
-                'id': task.id,
-                'parent_id': None,
-                'title': task.title,
-                'status': task.status,
-                'deadline': task.deadline.isoformat(),
-                'estimate_min': task.estimate_min,
-                'importance': task.importance,
-                'tags': task.tags,
-                'shared': task.shared,
-                'score': round(score, 3),
-                'has_subtasks': task.subtasks.exists()
+        # ページング（limit 省略時は全件）
+        limit = request.GET.get('limit')
+        limit = int(limit) if limit else None
+        offset = int(request.GET.get('offset', 0))
+        if (limit is not None and limit <= 0) or offset < 0:
+            return JsonResponse({'error': 'Invalid limit/offset'}, status=400)
+        
+        # 返すフィールド（fields=）とサブタスクの有無（include=subtasks）
+        fields, include_subtasks = parse_sparse_fields(
+            request, SORTED_TASK_FIELDS, required=('id', 'parent_id'))
+        
+        pages = get_sorted_tasks_multi(request.user, type_names, limit=limit, offset=offset)
+        
+        orderings = {}
+        for type_name, (scored_tasks, total) in pages.items():
+            next_offset = offset + len(scored_tasks)
+            orderings[type_name] = {
+                'total': total,
+                'next_offset': next_offset if next_offset < total else None,
+                'tasks': serialize_sorted_tasks(scored_tasks, fields, include_subtasks)
             }
-            tasks_data.append(task_data)
             
-            # サブタスクを追加
-            for subtask in task.subtasks.all():
-                subtask_data = {
-                    'id': subtask.id,
-                    'parent_id': task.id,
-                    'title': subtask.title,
-                    'status': subtask.status,
-                    'estimate_min': subtask.estimate_min,
-                    'order_index': subtask.order_index
-                }
-                tasks_data.append(subtask_data)
-        
-        # SortLogを記録
-        top_ids = [task.id for task, _, _ in scored_tasks[:5]]
-        SortLog.objects.create(
-            user=request.user,
-            type=type_name,
-            mode='manual',
-            sorted_at=timezone.now(),
-            item_count=len(scored_tasks),
-            top_ids=top_ids
-        )
+            # SortLogを記録（上位は表示ページではなく全体の先頭5件）
+            top_ids = top_task_ids(request.user, type_name, scored_tasks, offset, total)
+            sortlog_buffer.add(
+                user=request.user,
+                type=type_name,
+                mode='manual',
+                sorted_at=timezone.now(),
+                item_count=total,
+                top_ids=top_ids
+            )
         
-        return JsonResponse({
+        response = {
             'sorted_at': timezone.now().isoformat(),
+            'offset': offset,
+            'limit': limit,
             'policy': {
                 'window_days': 14,
                 'overdue_bonus_per_day': 0.1,
                 'step_add': {'D0': 0.6, 'D1': 0.4, 'D2': 0.15, 'D3': 0.05},
-                'penalty': '-log1p(estimate/30)'
-            },
-            'tasks': tasks_data
-        })
+                'penalty': '-log1p(estimate/30)',
+                'weights': {type_name: dict(SCORING_POLICIES[type_name]) for type_name in type_names}
+            }
+        }
+        if types_param:
+            response['orderings'] = orderings
+        else:
+            response.update(orderings[type_names[0]])
+        return JsonResponse(response)
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=400)
 
@@ -745,14 +1263,19 @@ def api_recompute_order(request):
     """手動ソート実行"""
     try:
         type_name = request.GET.get('type', 'planner')
-        if type_name not in ['planner', 'sprinter', 'flow']:
+        if type_name not in SCORING_POLICIES:
             return JsonResponse({'error': 'Invalid type'}, status=400)
         
-        scored_tasks = compute_sorted_tasks(request.user, type_name)
+        version = get_data_version(request.user)
+        scored_tasks, valid_until = compute_sorted_tasks_with_expiry(request.user, type_name)
+        
+        # ソート順を保存（次回以降の取得はこれを読む。計算中に書き込みがあれば保存しない）
+        store_ranking(request.user.id, type_name,
+                      [(row['id'], score) for row, score, _ in scored_tasks], valid_until, version)
         
         # SortLogを記録
-        top_ids = [task.id for task, _, _ in scored_tasks[:5]]
-        SortLog.objects.create(
+        top_ids = [row['id'] for row, _, _ in scored_tasks[:5]]
+        sortlog_buffer.add(
             user=request.user,
             type=type_name,
             mode='manual',
@@ -777,12 +1300,11 @@ def api_sort_settings(request):
         data = json.loads(request.body)
         profile, created = UserProfile.objects.get_or_create(user=request.user)
         
-        if 'auto_sort' in data:
-            profile.auto_sort = data['auto_sort']
-        if 'archive_after_days' in data:
-            profile.archive_after_days = data['archive_after_days']
+        fields = [name for name in ('auto_sort', 'archive_after_days') if name in data]
+        for name in fields:
+            setattr(profile, name, data[name])
         
-        profile.save()
+        profile.save(update_fields=fields)
         return JsonResponse({'ok': True})
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=400)
@@ -800,18 +1322,21 @@ def api_subtask_create(request):
         if data.get('estimate_min', 15) < 5:
             return JsonResponse({'error': 'estimate_min must be >= 5'}, status=400)
         
-        subtask = SubTask.objects.create(
-            task=task,
-            title=data['title'],
-            estimate_min=data.get('estimate_min', 15),
-            order_index=data.get('order_index', 0)
-        )
-        
-        # 親のestimate_minを子合計で更新
-        subtasks = task.subtasks.all()
-        if subtasks.exists():
-            task.estimate_min = sum(st.estimate_min for st in subtasks)
-            task.save()
+        with transaction.atomic(), deferred_user_changes():
+            subtask = SubTask.objects.create(
+                task=task,
+                title=data['title'],
+                estimate_min=data.get('estimate_min', 15),
+                order_index=data.get('order_index', 0)
+            )
+            
+            # 親のestimate_minを子合計で更新（集計はサブタスク保存時に同期済み）
+            Task.objects.filter(id=task.id).update(
+                estimate_min=F('subtask_estimate_total'),
+                updated_at=timezone.now(),
+                change_seq=None
+            )
+            user_data_changed(request.user.id)
         
         return JsonResponse({
             'ok': True,
@@ -822,51 +1347,19 @@ def api_subtask_create(request):
 
 
 # ヒートマップ関連の関数
-def bucket_index(dt_jst):
-    """30分ビンのインデックスを計算"""
-    dow = dt_jst.weekday()  # 0=Mon
-    slot = dt_jst.hour * 2 + (1 if dt_jst.minute >= 30 else 0)
-    return dow, slot  # 0..6, 0..47
+def week_bins(user, week_start, stored=None):
+    """週の30分ビンデータ（7×48、秒）
 
-
-def week_bins(user, week_start):
-    """週の30分ビンデータを計算"""
-    # 初期化
-    bins = [[0] * 48 for _ in range(7)]
-    
-    # 週の範囲
-    start = timezone.make_aware(datetime.combine(week_start, datetime.min.time()))
-    end = start + timedelta(days=7)
-    
-    logs = FocusLog.objects.filter(
-        user=user,
-        started_at__lt=end,
-        stopped_at__gt=start
-    )
-    
-    for log in logs:
-        # logを30分境界で分割加算（部分重なり分も按分）
-        log_start = max(log.started_at, start)
-        log_end = min(log.stopped_at, end)
-        
-        # 30分単位で分割
-        current = log_start
-        while current < log_end:
-            next_boundary = current.replace(
-                minute=(current.minute // 30) * 30,
-                second=0,
-                microsecond=0
-            ) + timedelta(minutes=30)
-            
-            segment_end = min(next_boundary, log_end)
-            segment_seconds = int((segment_end - current).total_seconds())
-            
-            dow, slot = bucket_index(timezone.localtime(current))
-            bins[dow][slot] += segment_seconds
-            
-            current = segment_end
-    
-    return bins  # 秒
+    月曜始まりの週は保存済みの週ビン（stored に先読み済みならそれ）を使い、
+    まだ保存されていない今週までの週は計算して保存する。
+    月曜以外から始まる週と未来の週は FocusLog から計算するだけで保存しない。
+    """
+    if week_start.weekday() != 0 or week_start > monday_of(jst_now().date()):
+        return to_grid(logged_week_bins(user.id, week_start))  # 秒
+    if stored is not None and week_start in stored:
+        return to_grid(stored[week_start])  # 秒
+    row, created = get_or_create_week_bins(user.id, week_start)
+    return to_grid(row.bins)  # 秒
 
 
 def quantize(bins):
@@ -903,16 +1396,20 @@ def quantize(bins):
     return levels, max_sec
 
 
+# 平均ヒートマップで遡る最大の週数（月平均は1か月を4週として数える）
+HEATMAP_MAX_WEEKS = 52
+
+
 def week_avg_bins(user, window_weeks=4):
     """週平均ビンデータを計算"""
     # 直近window_weeks分の週を遡る
     stacks = [[[] for _ in range(48)] for __ in range(7)]  # 各ビンの非ゼロ値を積む
     
     now = jst_now()
-    for k in range(window_weeks):
-        # 週の開始日を計算（月曜日）
-        week_start = now.date() - timedelta(days=now.weekday() + 7 * k)
-        bins = week_bins(user, week_start)
+    week_starts = [now.date() - timedelta(days=now.weekday() + 7 * k) for k in range(window_weeks)]
+    stored = stored_week_bins(user, week_starts)  # 保存済みの週ビンをまとめて読む
+    for week_start in week_starts:
+        bins = week_bins(user, week_start, stored)
         
         for d in range(7):
             for s in range(48):
@@ -973,6 +1470,9 @@ def api_heatmap_avg(request):
     try:
         mode = request.GET.get('mode', 'week')  # week|month
         window = int(request.GET.get('window', 4 if mode == 'week' else 3))
+        max_window = HEATMAP_MAX_WEEKS if mode == 'week' else HEATMAP_MAX_WEEKS // 4
+        if not 1 <= window <= max_window:
+            return JsonResponse({'error': f'window must be 1-{max_window}'}, status=400)
         
         if mode == 'week':
             avg_bins = week_avg_bins(request.user, window)
@@ -1143,7 +1643,7 @@ def api_task_share(request, task_id):
         
         # 共有フラグを切り替え
         task.shared = not task.shared
-        task.save()
+        task.save(update_fields=['shared', 'updated_at'])
         
         # 共有された場合はTimelineEventを作成、解除された場合は削除
         if task.shared: